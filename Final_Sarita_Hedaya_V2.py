@@ -1,6 +1,27 @@
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, defaultdict, deque
+from itertools import accumulate, chain, groupby, islice, repeat
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import redirect_stdout
+from operator import itemgetter, or_, sub
 from prettytable import PrettyTable
+import asyncio
+import csv
+import heapq
+import io
+import json
+import math
+import mmap
 import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import tracemalloc
+import time
 import unittest
 
 
@@ -30,72 +51,719 @@ def file_reader(file_name, fields_per_line, separator=',', header=False):
                     continue
                 yield tuple(line)
 
+def file_batches(file_name, fields_per_line, separator=',', header=False, chunk_size=1 << 20):
+    """this generator reads the file in blocks of chunk_size characters and yields a list of field tuples per block.
+    Same validation and line numbers as file_reader, but lines are split in bulk instead of one next() at a time """
+    try:
+        fp = open(file_name, 'r')
+    except FileNotFoundError:
+        print("can't open", file_name)
+    else:
+        with fp:
+            line_number = 1 # line number of the first line in the current block
+            remainder = '' # partial line left at the end of the previous block
+            while True:
+                block = fp.read(chunk_size)
+                if block:
+                    lines = (remainder + block).split('\n')
+                    remainder = lines.pop() # the last piece is either '' or a line that continues in the next block
+                elif remainder:
+                    lines, remainder = [remainder], '' # last line of the file had no trailing newline
+                else:
+                    break
+
+                batch = [tuple(line.split(separator)) for line in lines] # text mode already turned \r\n into \n
+                if set(map(len, batch)) - {fields_per_line}: # only walk the batch one line at a time if something is wrong
+                    for offset, fields in enumerate(batch):
+                        if len(fields) != fields_per_line:
+                            break
+                    good = batch[1:offset] if header else batch[:offset]
+                    if good:
+                        yield good # rows before the bad line are still delivered, just like file_reader
+                    raise ValueError(file_name, "has", len(fields), "fields in", line_number + offset, "but expected", fields_per_line)
+
+                line_number += len(batch)
+                if header and batch: # skip the header line only once
+                    header = False
+                    batch = batch[1:]
+                if batch:
+                    yield batch
+
+
+class _IdTable(dict):
+    """ maps the raw bytes of an id to one interned str, decoding each distinct id only the first time it is seen """
+    def __missing__(self, raw):
+        value = self[raw] = sys.intern(raw.decode())
+        return value
+
+
+def _parses_as_int(raw):
+    try:
+        int(raw)
+    except ValueError:
+        return False
+    return True
+
+
+def mmap_batches(file_name, fields_per_line, separator='|', header=False, int_fields=(), chunk_size=1 << 20, ids=None, tail=None, as_columns=False):
+    """this generator maps the file into memory and yields a list of field tuples per block of about chunk_size bytes.
+    Same validation and line numbers as file_batches, but fields stay bytes until the end: the int_fields columns are
+    parsed straight to int, the others go through ids (an _IdTable) so each repeated id is one shared str.
+    A field count or a number that is wrong raises a ValueError with its line number, after the rows before it.
+    With a FileTail as tail, reading stops at the last newline and the tail is positioned right after it, so a line
+    that is still being written, and anything appended later, is left for tail.read().
+    With as_columns=True each block is a list of fields_per_line column lists instead of a list of rows """
+    try:
+        fp = open(file_name, 'rb')
+    except FileNotFoundError:
+        print("can't open", file_name)
+        return
+    with fp:
+        size = os.fstat(fp.fileno()).st_size
+        if not size:
+            return
+        ids = _IdTable() if ids is None else ids
+        sep = separator.encode()
+
+        def to_rows(fields):
+            """ turn the flat list of fields of whole lines into row tuples """
+            columns = [list(map(int, fields[field::fields_per_line])) if field in int_fields else list(map(ids.__getitem__, fields[field::fields_per_line]))
+                       for field in range(fields_per_line)]
+            return columns if as_columns else list(zip(*columns))
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if tail is not None:
+                size = mm.rfind(b'\n') + 1
+            line_number = 1 # line number of the first line in the current block
+            start = counted = 0 # the lines before byte counted are in line_number
+            try:
+                while start < size:
+                    end = mm.find(b'\n', min(start + chunk_size, size) - 1) # blocks end on a newline, so no line is split
+                    if end == -1:
+                        end = size
+                    block = mm[start:end]
+                    start = end + 1
+                    if b'\r' in block:
+                        block = block.replace(b'\r\n', b'\n')
+                        if block.endswith(b'\r'): # the block stops just before a newline, so its last line still ends in \r
+                            block = block[:-1]
+                    lines = block.split(b'\n')
+                    counts = list(map(bytes.count, lines, repeat(sep)))
+                    good = len(lines)
+                    if set(counts) - {fields_per_line - 1}: # rows before the bad line are still delivered, just like file_reader
+                        good = next(offset for offset, count in enumerate(counts) if count != fields_per_line - 1)
+                    skip = 1 if header else 0 # skip the header line only once
+                    header = False
+                    if good > skip:
+                        # every line has the same number of fields, so the fields of the block split in one go and
+                        # column i is every fields_per_line'th field from i, without a list per line
+                        fields = block.replace(b'\n', sep).split(sep, good * fields_per_line)[skip * fields_per_line:good * fields_per_line]
+                        try:
+                            rows = to_rows(fields)
+                        except ValueError: # a number that doesn't parse: deliver the rows before its line, then report the line
+                            row, field = next((row, field) for row in range(len(fields) // fields_per_line) for field in int_fields
+                                              if not _parses_as_int(fields[row * fields_per_line + field]))
+                            if row:
+                                yield to_rows(fields[:row * fields_per_line])
+                            raise ValueError(file_name, "has", lines[skip + row].split(sep)[field].decode(errors='replace'), "in field", field + 1,
+                                             "of", line_number + skip + row, "but expected an integer")
+                        yield rows
+                    if good < len(lines):
+                        raise ValueError(file_name, "has", counts[good] + 1, "fields in", line_number + good, "but expected", fields_per_line)
+                    line_number += len(lines)
+                    counted = start
+            finally:
+                if tail is not None: # even after a bad line, the tail carries on after what the import covered
+                    tail.seek(size, line_number - 1 + mm[counted:size].count(b'\n'), os.fstat(fp.fileno()).st_ino)
+
+
+class FileTail:
+    """ Remembers how far into a data file we have read, so that only the lines appended later are returned.
+    The file is only opened by the first read, so loading an Ecommerce doesn't hold its data files open
+    (on Windows an open file can't be renamed, which would block log rotation). From then on it is kept
+    open until close(), so lines written to it just before it was rotated (renamed and replaced by a new
+    file) are still read before moving on to the new file. A file that shrinks has been truncated and is
+    read again from the start. An unterminated last line is held back until it is complete.
+    Rows are checked before they are returned: the int_fields columns must be numbers and, for each
+    (field, mapping) in keys, the field must be a key of the mapping. A bad row is reported and skipped,
+    so it can't stop the rows after it from being applied.
+    """
+    def __init__(self, file_name, fields_per_line, separator=',', header=False, at_end=False, int_fields=(), keys=()):
+        self.file_name = file_name
+        self.fields_per_line = fields_per_line
+        self.separator = separator
+        self.header = header
+        self.int_fields = int_fields
+        self.keys = keys  # ((field, mapping of the known ids), ...)
+        self.fp = None  # opened by the first read
+        self.inode = None  # the file the position below belongs to
+        self.offset = 0  # bytes of the current file already read
+        self.partial = b''  # start of a line whose newline hasn't been written yet
+        self.line_number = 0  # lines of the current file already read
+        self.skip_header = header
+        if at_end:
+            self.seek_end()
+
+    def _open(self):
+        """ open the file, continuing from the position if it is still the same file and starting from the top
+        if it has been replaced. Returns False if it doesn't exist (yet) """
+        try:
+            fp = open(self.file_name, 'rb')
+        except FileNotFoundError:
+            return False
+        if self.fp is not None:
+            self.fp.close()
+        self.fp = fp
+        inode = os.fstat(fp.fileno()).st_ino
+        if inode != self.inode:
+            self.inode = inode
+            self._rewind()
+        return True
+
+    def _rewind(self):
+        self.offset, self.partial, self.line_number, self.skip_header = 0, b'', 0, self.header
+
+    def seek_end(self):
+        """ skip everything currently in the file, e.g. transactions that are deliberately not imported """
+        try:
+            fp = open(self.file_name, 'rb')
+        except FileNotFoundError:
+            return
+        with fp:
+            self.inode = os.fstat(fp.fileno()).st_ino
+            self._rewind()
+            for block in iter(lambda: fp.read(1 << 20), b''):
+                self.offset += len(block)
+                self.line_number += block.count(b'\n')
+        if self.line_number:
+            self.skip_header = False
+
+    def seek(self, offset, line_number, inode=None):
+        """ continue from a position saved earlier. If the file has been replaced since, read the new one from the top """
+        try:
+            status = os.stat(self.file_name)
+        except FileNotFoundError:
+            return
+        if (inode is None or inode == status.st_ino) and offset <= status.st_size:
+            self.inode = status.st_ino
+            self.offset, self.partial, self.line_number = offset, b'', line_number
+            self.skip_header = self.header and line_number == 0
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    __del__ = close
+
+    def read(self):
+        """ return the field tuples of the complete lines appended since the last read """
+        if self.fp is None and not self._open():
+            return []
+        rows = self._drain()
+        try:
+            status = os.stat(self.file_name)
+        except FileNotFoundError:
+            return rows  # rotated away and the new file isn't there yet, it will be picked up next time
+        if status.st_ino != self.inode:
+            rows.extend(self._parse(self.partial + b'\n' if self.partial else b''))  # the old file is finished, so its last line is complete
+            self._open()
+            rows.extend(self._drain())
+        elif status.st_size < self.offset:
+            self._rewind()
+            rows.extend(self._drain())
+        return rows
+
+    def _drain(self):
+        """ read to the end of the current file and parse the complete lines """
+        self.fp.seek(self.offset)
+        data = self.fp.read()
+        self.offset += len(data)
+        data = self.partial + data
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        return self._parse(data[:end])
+
+    def _parse(self, data):
+        """ split newline terminated bytes into field tuples. Bad lines are reported like the import methods do and skipped """
+        rows = []
+        for line in data.decode().split('\n')[:-1]:
+            self.line_number += 1
+            fields = tuple(line.rstrip('\r').split(self.separator))
+            if len(fields) != self.fields_per_line:
+                print(ValueError(self.file_name, "has", len(fields), "fields in", self.line_number, "but expected", self.fields_per_line))
+            elif self.skip_header:
+                self.skip_header = False
+            else:
+                try:
+                    rows.append(self._check(fields))
+                except ValueError as e:
+                    print(e)
+        return rows
+
+    def _check(self, fields):
+        """ return the row with its int_fields parsed, or raise a ValueError for a bad number or an unknown id """
+        if self.int_fields:
+            fields = list(fields)
+            for field in self.int_fields:
+                try:
+                    fields[field] = int(fields[field])
+                except ValueError:
+                    raise ValueError(self.file_name, "has", fields[field], "in field", field + 1, "of", self.line_number, "but expected an integer") from None
+            fields = tuple(fields)
+        for field, known in self.keys:
+            if fields[field] not in known:
+                raise ValueError(self.file_name, "has unknown id", fields[field], "in field", field + 1, "of", self.line_number)
+        return fields
+
+
+def source_stats(dir_path):
+    """ return {file name: [size, mtime_ns, inode]} for the source files, None for a missing file """
+    stats = dict()
+    for file_name in SOURCE_FILES:
+        try:
+            status = os.stat(os.path.join(dir_path, file_name))
+        except FileNotFoundError:
+            stats[file_name] = None
+        else:
+            stats[file_name] = [status.st_size, status.st_mtime_ns, status.st_ino]
+    return stats
+
+
+def read_snapshot_header(buffer):
+    """ return the JSON header of a snapshot held in buffer, or raise ValueError if it isn't one """
+    if bytes(buffer[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+        raise ValueError("not an Ecommerce snapshot")
+    length = int.from_bytes(buffer[8:16], 'little')
+    return json.loads(bytes(buffer[16:16 + length]))
+
+
+def snapshot_is_fresh(path, dir_path):
+    """ True if the snapshot at path can stand in for reading the files in dir_path: the customers,
+    stores and products files are unchanged, and inventory/transactions are the same files and
+    at least as long as when it was taken (ingest then reads the rest). A header that is malformed or
+    incomplete counts as stale, so the files are read again
+    """
+    stats = source_stats(dir_path)
+    try:
+        with open(path, 'rb') as fp:
+            start = fp.read(16)
+            header = read_snapshot_header(start + fp.read(int.from_bytes(start[8:16], 'little')))
+        if header['byteorder'] != sys.byteorder:
+            return False
+        for file_name in SOURCE_FILES:
+            saved, current = header['sources'][file_name], stats[file_name]
+            if file_name not in APPEND_ONLY_FILES:
+                if saved != current:
+                    return False
+            elif current is not None:
+                inode, offset, _ = header['tails'][file_name]
+                if inode != current[2] or offset > current[0]:
+                    return False
+    except (FileNotFoundError, ValueError, KeyError, TypeError):
+        return False
+    return True
+
+
+def benchmark_reader(file_name, fields_per_line, separator=',', header=False, repeat=3):
+    """ time file_reader, file_batches and mmap_batches on the same file and return the best lines/sec of each """
+    results = dict()
+    readers = {
+        'file_reader': lambda: sum(1 for _ in file_reader(file_name, fields_per_line, separator, header)),
+        'file_batches': lambda: sum(len(batch) for batch in file_batches(file_name, fields_per_line, separator, header)),
+        'mmap_batches': lambda: sum(len(batch) for batch in mmap_batches(file_name, fields_per_line, separator, header)),
+    }
+    for reader_name, read_all in readers.items():
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            lines = read_all()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[reader_name] = lines / best if best else float('inf')
+        print("{}: {} lines in {:.3f}s ({:,.0f} lines/sec)".format(reader_name, lines, best, results[reader_name]))
+    return results
+
+SOURCE_FILES = ('customers.txt', 'stores.txt', 'products.txt', 'inventory.txt', 'transactions.txt')
+APPEND_ONLY_FILES = ('inventory.txt', 'transactions.txt')  # files that ingest picks up new lines from
+SNAPSHOT_MAGIC = b'ECSNAP01'
+SNAPSHOT_SECTIONS = ('customers', 'purchases', 'stores', 'stock', 'sales')
+
+
 class Ecommerce:
     """ Class Ecommerce imports data from .txt files, organizes such data into 
     dictionaries with classes, and prints them in prettytable format """
-    def __init__(self, dir_path):
+    def __init__(self, dir_path, compact=False, transaction_log=None, processes=None, snapshot=None, transactions=True, metrics=None, analytics=None, batch=False):
+        self._init_state(dir_path, compact, transaction_log, metrics, analytics)
+
+        if snapshot is not None and snapshot_is_fresh(snapshot, dir_path):
+            self._stage('load_snapshot', snapshot, self.load_snapshot, snapshot) # same state as re-reading the files, then catch up on the appended lines
+            self._stage('ingest', None, self.ingest)
+            return
+
+        # Calls functions that import Ecommerce data from files
+        self._stage('import_customers', "customers.txt", self.import_customers, dir_path)
+        self._stage('import_stores', "stores.txt", self.import_stores, dir_path)
+        self._stage('import_products', "products.txt", self.import_products, dir_path)
+        self.tails['inventory.txt'] = self._file_tail('inventory.txt') # positioned by the import, where it stopped reading
+        self._stage('import_inventory', "inventory.txt", self.import_inventory, dir_path)
+        # transactions=False starts from the inventory alone, e.g. to take live orders through an OrderEngine
+        self.tails['transactions.txt'] = self._file_tail('transactions.txt', at_end=not transactions)
+        if transactions:
+            self._stage('import_transactions', "transactions.txt", self.import_transactions, dir_path, processes, batch)
+        if snapshot is not None:
+            self._stage('save_snapshot', None, self.save_snapshot, snapshot)
+
+    @classmethod
+    def empty(cls, dir_path, compact=False, transaction_log=None, metrics=None, analytics=None):
+        """ return an Ecommerce for dir_path with nothing imported yet, so the import methods can be run one at a time """
+        ecommerce = cls.__new__(cls)
+        ecommerce._init_state(dir_path, compact, transaction_log, metrics, analytics)
+        return ecommerce
+
+    def _stage(self, name, file_name, method, *args, **options):
+        """ run one stage of the pipeline, measured by self.metrics if there is one """
+        if self.metrics is None:
+            return method(*args, **options)
+        if file_name is not None:
+            file_name = os.path.join(self.dir_path, file_name)
+        return self.metrics.measure(name, method, args, file_name, options)
+
+    def _file_tail(self, file_name, at_end=False):
+        """ return a FileTail for one of the APPEND_ONLY_FILES, which skips rows with a bad quantity or an unknown customer or store """
+        if file_name == 'inventory.txt':
+            return FileTail(os.path.join(self.dir_path, file_name), 3, '|', True, at_end, int_fields=(1,), keys=((0, self.stores),))
+        return FileTail(os.path.join(self.dir_path, file_name), 4, '|', True, at_end, int_fields=(1,), keys=((0, self.customers), (3, self.stores)))
+
+    def _init_state(self, dir_path, compact, transaction_log, metrics, analytics=None):
         self.dir_path = dir_path
+        self.metrics = metrics  # Metrics collecting per stage timings, or None for no instrumentation at all
+        self.analytics = analytics  # SalesWindows fed every settled purchase, or None
+        self.transaction_log = TransactionLog() if transaction_log is None else transaction_log  # where each purchase is reported
         self.customers = dict()  # self.customers[cust_id] = instance of class Customer
-        self.stores = dict()  # self.stores[store_id] = instance of class Store
+        self.stores = dict()  # self.stores[store_id] = instance of class Store (or CompactStore)
+        self.interner = IdInterner() if compact else None  # shared id <-> code table for compact stores
+        self.tails = dict()  # self.tails[file name] = FileTail positioned after the lines already imported
+        self.index = None  # SalesIndex behind the query methods, built on the first query
         # self._products = dict() # self.products[product] = instance of class Product
 
-        # Calls functions that import Ecommerce data from files
-        self.import_customers(dir_path)
-        self.import_stores(dir_path)
-        self.import_products(dir_path)
-        self.import_inventory(dir_path)
-        self.import_transactions(dir_path)
-
 
     # Methods that import data from .txt files, and create instances of classes as values in dicitonaries
     def import_customers(self, dir_path):
-        """ Pulls customer data from .txt file and organizes it into the customers dictionary """
+        """ Pulls customer data from .txt file and organizes it into the customers dictionary. Returns the rows read """
         customers_file = os.path.join(dir_path, "customers.txt")
+        rows = 0
         try:
-            for cust_id, name in file_reader(customers_file, 2, ','):
-                self.customers[cust_id] = Customer(cust_id, name)
+            for batch in file_batches(customers_file, 2, ','):
+                rows += len(batch)
+                for cust_id, name in batch:
+                    cust_id = self.interner.intern(cust_id) if self.interner is not None else sys.intern(cust_id) # the dict key and the customer share one string
+                    self.customers[cust_id] = Customer(cust_id, name)
         except ValueError as e:
             print(e)
+        return rows
 
     def import_stores(self, dir_path):
-        """ Pulls store data from .txt file and organizes it into the stores dictionary """
+        """ Pulls store data from .txt file and organizes it into the stores dictionary. Returns the rows read """
         stores_file = os.path.join(dir_path, "stores.txt")
+        rows = 0
         try:
-            for store_id, name in file_reader(stores_file, 2, '*', True):
-                self.stores[store_id] = Store(store_id, name)
+            for batch in file_batches(stores_file, 2, '*', True):
+                rows += len(batch)
+                for store_id, name in batch:
+                    if self.interner is not None:
+                        store_id = self.interner.intern(store_id)
+                        self.stores[store_id] = CompactStore(store_id, name, self.interner)
+                    else:
+                        store_id = sys.intern(store_id)
+                        self.stores[store_id] = Store(store_id, name)
         except ValueError as e:
             print(e)
+        return rows
 
     def import_products(self, dir_path):
-        """ reads products from file in dir_path and adds them to a dictionary self._products """
+        """ reads products from file in dir_path and adds them to a dictionary self._products. Returns the rows read """
         products_file = os.path.join(dir_path, "products.txt")
+        rows = 0
         try:
-            for product_id, store_id, product_name in file_reader(products_file, 3, separator='|', header=False):
-                self.stores[store_id].add_product(product_id) #creates an entry on the products dictionary. For now, qty is zero
+            for batch in mmap_batches(products_file, 3, separator='|', header=False):
+                rows += len(batch)
+                for product_id, store_id, product_name in batch:
+                    self.stores[store_id].add_product(product_id) #creates an entry on the products dictionary. For now, qty is zero
         except ValueError as e:
             print(e)        
+        return rows
 
     def import_inventory(self, dir_path):
-        """ reads inventory from file in dir_path and adds them to a dictionary self.inventory """
+        """ reads inventory from file in dir_path and adds them to a dictionary self.inventory. Returns the rows read """
         products_file = os.path.join(dir_path, "inventory.txt")
+        rows = 0
         try:
-            for store_id, quantity, product_id in file_reader(products_file, 3, separator='|', header=True):
-                self.stores[store_id].add_product(product_id, quantity)
+            for batch in mmap_batches(products_file, 3, separator='|', header=True, int_fields=(1,), tail=self.tails.get('inventory.txt')):
+                rows += len(batch)
+                for store_id, quantity, product_id in batch:
+                    self.stores[store_id].add_product(product_id, quantity)
         except ValueError as e:
             print(e)
+        return rows
 
-    def import_transactions(self, dir_path):
+    def import_transactions(self, dir_path, processes=None, batch=False):
         """ read the transactions file, update the customer to note the purchase, update store to 
             note the sell. Only sell if item in stock. If customer wants more than whats in stock he will recieve the stock.
+            With batch=True or processes > 1 the whole file is read first, as columns, and settled all at once like
+            settle_batch, with processes > 1 on a process pool like settle_transactions.
+            Every purchase is reported to self.transaction_log, which is flushed at the end, and to self.analytics.
+            Returns the rows read.
         """
         transactions_file = os.path.join(dir_path, "transactions.txt")
+        if batch or (processes is not None and processes > 1):
+            columns = [[], [], [], []]  # cust_id, quantity, product_id, store_id
+            try:
+                for block in mmap_batches(transactions_file, 4, '|', True, int_fields=(1,), tail=self.tails.get('transactions.txt'), as_columns=True):
+                    for column, values in zip(columns, block):
+                        column.extend(values)
+            except ValueError as e:
+                print(e) # like the sequential loop, the rows before the bad line are still settled
+            try:
+                self._settle_columns(*columns, processes=processes)
+            finally:
+                self.transaction_log.flush()
+            return len(columns[1])
+
+        rows = 0
         try:
-            for cust_id, quantity, product_id, store_id in file_reader(transactions_file, 4, '|', True):
-                print("Customer {} wants {} of {}. Store {} has {} in stock. Customer will recieve {}".format(cust_id, quantity, product_id, store_id, self.stores[store_id].products[product_id], min(int(quantity), self.stores[store_id].products[product_id])))
-                self.customers[cust_id].buy_product(product_id, min(int(quantity), self.stores[store_id].products[product_id])) # adds dictionary entry pair. See def in class Customer
-                self.stores[store_id].sell_product(product_id, min(int(quantity), self.stores[store_id].products[product_id]), cust_id) # adds a customer and product sold in store. See def in Store class.
+            for batch in mmap_batches(transactions_file, 4, '|', True, int_fields=(1,), tail=self.tails.get('transactions.txt')):
+                rows += len(batch)
+                self._settle_rows(batch)
         except ValueError as e:
             print(e)    
+        finally:
+            self.transaction_log.flush()
+        return rows
+
+    def _settle_rows(self, transactions):
+        """ settle (cust_id, quantity, product_id, store_id) rows one at a time, in order """
+        record = self.transaction_log.record if self.transaction_log.enabled else None
+        window = self.analytics.record if self.analytics is not None else None
+        for cust_id, quantity, product_id, store_id in transactions:
+            if self.interner is not None:
+                product_id = self.interner.intern(product_id) # customers share the store's copy of the id string
+            store = self.stores[store_id]
+            in_stock = store.products[product_id]
+            received = min(int(quantity), in_stock) # the customer gets what they asked for, or whatever is left
+            if record is not None:
+                record(cust_id, quantity, product_id, store_id, in_stock, received)
+            if window is not None:
+                window(cust_id, product_id, store_id, received)
+            self.customers[cust_id].buy_product(product_id, received) # adds dictionary entry pair. See def in class Customer
+            store.sell_product(product_id, received, cust_id) # adds a customer and product sold in store. See def in Store class.
+
+    def settle_batch(self, transactions):
+        """ settle a list of (cust_id, quantity, product_id, store_id) rows all at once with settle_requests, with the
+            same results as the sequential loop, then write the sales and purchases per store product and per customer.
+            Once the query index is built every sale has to reach it in order, so the rows are settled one at a time.
+        """
+        if self.index is not None or not transactions:
+            self._settle_rows(transactions)
+            return
+        self._settle_columns(*map(list, zip(*transactions)))
+
+    def _settle_columns(self, custs, quantities, products, stores, processes=None):
+        """ settle_batch for rows already split into columns, on a pool of processes if processes > 1 """
+        if self.index is not None:
+            self._settle_rows(zip(custs, quantities, products, stores))
+            return
+        custs = list(map(sys.intern, custs))
+        products = list(map(self.interner.intern if self.interner is not None else sys.intern, products))
+        quantities = list(map(int, quantities))
+        if processes is not None and processes > 1:
+            in_stock, received, bought = self._settle_shards(custs, quantities, products, stores, processes)
+        else:
+            stock = {(store_id, product_id): self.stores[store_id].products.get(product_id, 0) for store_id, product_id in dict.fromkeys(zip(stores, products))}
+            in_stock, received, sales = settle_requests(stock, custs, quantities, products, stores, self.transaction_log.enabled)
+            for (store_id, product_id), sold in sales.items():
+                self.stores[store_id].add_sales(product_id, sold)
+            bought = tally_purchases(custs, products, received)
+
+        if self.transaction_log.enabled:
+            record = self.transaction_log.record
+            for cust_id, quantity, product_id, store_id, before, units in zip(custs, quantities, products, stores, in_stock, received):
+                record(cust_id, quantity, product_id, store_id, before, units)
+        if self.analytics is not None: # in file order, like the sequential loop
+            window = self.analytics.record
+            for cust_id, product_id, store_id, units in zip(custs, products, stores, received):
+                window(cust_id, product_id, store_id, units)
+        for cust_id, purchases in bought.items():
+            self.customers[cust_id].add_purchases(purchases)
+
+    def _settle_shards(self, custs, quantities, products, stores, processes):
+        """ settle interned columns on a pool of processes, one shard per store. Stock only moves within a store, so
+            each worker settles its store with settle_shard and sends back the store's sales and units sold, which
+            are written once per store product. The parent then only tallies the customers, who buy across stores.
+            Returns (in_stock, received, bought) like _settle_columns uses them, in_stock only if the log is on.
+        """
+        count = len(quantities)
+        first = dict()  # first[store_id] = row of its first request
+        store_rows = list(map(first.setdefault, stores, range(count)))
+        order = sorted(range(count), key=store_rows.__getitem__)  # stable, so each store's requests stay in file order
+        starts = list(accumulate(Counter(store_rows).values(), initial=0))
+        shards = []  # the arguments of settle_shard, one tuple per store
+        for store_id, start, end in zip(first, starts, starts[1:]):
+            positions = order[start:end]
+            shard_products = list(map(products.__getitem__, positions))
+            stock = self.stores[store_id].products
+            shards.append(({(store_id, product_id): stock.get(product_id, 0) for product_id in dict.fromkeys(shard_products)},
+                           list(map(custs.__getitem__, positions)), list(map(quantities.__getitem__, positions)),
+                           shard_products, store_id, positions, self.transaction_log.enabled))
+        with ProcessPoolExecutor(processes) as pool:
+            results = list(pool.map(settle_shard, *zip(*shards), chunksize=max(1, len(shards) // (processes * 4))))
+
+        in_stock = [0] * count if self.transaction_log.enabled else None
+        received = [0] * count
+        for (_, _, _, _, store_id, positions, _), (seen, units, sales, units_sold) in zip(shards, results):
+            deque(map(received.__setitem__, positions, units), maxlen=0) # back to file order
+            if in_stock is not None:
+                deque(map(in_stock.__setitem__, positions, seen), maxlen=0)
+            store = self.stores[store_id]
+            for row, sold in sales.items(): # the rows give back the ids interned here
+                store.add_sales(products[row], dict(zip(map(custs.__getitem__, sold), sold.values())), units_sold[row])
+        return in_stock, received, tally_purchases(custs, products, received)
+
+    def settle_transactions(self, transactions, processes=None):
+        """ settle a list of (cust_id, quantity, product_id, store_id) rows with the same results as the sequential loop.
+            With processes > 1 the rows are sharded by store and each shard is settled by settle_shard on a pool of
+            processes. Stock only moves within a store, so the shards are independent: every worker returns its
+            store's sales and aggregates, which are written once per store product, and the parent only merges the
+            customer tallies. Without processes the rows are simply settled in order.
+        """
+        if processes is None or processes <= 1 or not transactions:
+            self._settle_rows(transactions)
+            return
+        self._settle_columns(*map(list, zip(*transactions)), processes=processes)
+
+    def ingest(self):
+        """ apply the inventory and transactions appended to the files since the last load or ingest,
+            restocking first. Returns the number of new rows read from each file.
+        """
+        restock = self.tails['inventory.txt'].read()
+        for store_id, quantity, product_id in restock:
+            self.stores[store_id].add_product(product_id, quantity)
+        transactions = self.tails['transactions.txt'].read()
+        try:
+            self.settle_transactions(transactions)
+        finally:
+            self.transaction_log.flush()
+        return {'inventory.txt': len(restock), 'transactions.txt': len(transactions)}
+
+    def save_snapshot(self, path):
+        """ write customers, stores, stock, sales and how far the tails have read into a binary snapshot file.
+            Layout: magic, length of a JSON header, the header, then the '\\n' joined string table and one
+            native int64 array per section, each 8-byte aligned. The header has the section offsets and the
+            size/mtime of the source files used by snapshot_is_fresh.
+        """
+        strings = IdInterner()  # every id and name is stored once and referred to by its code
+        code = strings.code
+        sections = {name: array('q') for name in SNAPSHOT_SECTIONS}
+        for index, customer in enumerate(self.customers.values()):
+            sections['customers'].extend((code(customer.cust_id), code(customer.name)))
+            for product_id, quantity in customer.purchase_items():
+                sections['purchases'].extend((index, code(product_id), quantity))
+        for index, store in enumerate(self.stores.values()):
+            sections['stores'].extend((code(store.store_id), code(store.name)))
+            for product_id, quantity in store.products.items():
+                sections['stock'].extend((index, code(product_id), quantity))
+            for product_id, cust_id, quantity in store.sales_items():
+                sections['sales'].extend((index, code(product_id), code(cust_id), quantity))
+
+        blobs = ['\n'.join(strings.ids).encode()] + [sections[name].tobytes() for name in SNAPSHOT_SECTIONS]
+        positions, position = [], 0
+        for blob in blobs:
+            positions.append([position, len(blob)])
+            position += len(blob) + -len(blob) % 8
+        header = json.dumps({
+            'byteorder': sys.byteorder,
+            'sources': source_stats(self.dir_path),
+            'tails': {name: [tail.inode, tail.offset - len(tail.partial), tail.line_number] for name, tail in self.tails.items()},
+            'strings': positions[0],
+            'sections': dict(zip(SNAPSHOT_SECTIONS, positions[1:])),
+        }).encode()
+        header += b' ' * (-len(header) % 8)
+        with open(path + '.tmp', 'wb') as fp: # write aside and rename, so a crash never leaves half a snapshot
+            fp.write(SNAPSHOT_MAGIC)
+            fp.write(len(header).to_bytes(8, 'little'))
+            fp.write(header)
+            for blob in blobs:
+                fp.write(blob)
+                fp.write(bytes(-len(blob) % 8))
+        os.replace(path + '.tmp', path)
+
+    def load_snapshot(self, path):
+        """ rebuild customers, stores and the ingest positions from a file written by save_snapshot.
+            The file is memory-mapped and the sections are read in place as int64 arrays.
+        """
+        with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = read_snapshot_header(mm)
+            data = 16 + int.from_bytes(mm[8:16], 'little')  # sections start right after the header
+            start, length = header['strings']
+            ids = bytes(mm[data + start:data + start + length]).decode().split('\n')
+            view = memoryview(mm)
+            try:
+                sections = {name: view[data + start:data + start + length].cast('q') for name, (start, length) in header['sections'].items()}
+                self._restore(ids, sections)
+            finally:
+                for section in sections.values():
+                    section.release()
+                view.release()
+
+        for name in APPEND_ONLY_FILES:
+            tail = self.tails[name] = self._file_tail(name)
+            inode, offset, line_number = header['tails'][name]
+            tail.seek(offset, line_number, inode)
+
+    def _restore(self, ids, sections):
+        """ build the Customer and Store objects from the snapshot string table and int64 sections. Their dicts, or
+            a CompactStore's arrays, are filled in straight from the section columns instead of replaying the sales
+        """
+        ids = list(map(sys.intern, ids))  # every dict built below shares these copies
+        name = ids.__getitem__
+        customers = sections['customers']
+        for cust_id, cust_name in zip(map(name, customers[0::2]), map(name, customers[1::2])):
+            self.customers[cust_id] = Customer(cust_id, cust_name)
+        customer_list = list(self.customers.values())
+        purchases = sections['purchases']
+        product_ids, quantities = list(map(name, purchases[1::3])), purchases[2::3].tolist()
+        for index, start, end in _runs(purchases[0::3]):
+            customer_list[index]._products = defaultdict(int, zip(product_ids[start:end], quantities[start:end]))
+
+        stores = sections['stores']
+        for store_id, store_name in zip(map(name, stores[0::2]), map(name, stores[1::2])):
+            if self.interner is not None:
+                self.stores[store_id] = CompactStore(self.interner.intern(store_id), store_name, self.interner)
+            else:
+                self.stores[store_id] = Store(store_id, store_name)
+        stock = sections['stock']
+        product_ids, quantities = list(map(name, stock[1::3])), stock[2::3].tolist()
+        stocks = {index: dict(zip(product_ids[start:end], quantities[start:end])) for index, start, end in _runs(stock[0::3])}
+        sales = sections['sales']
+        cust_ids, quantities = list(map(name, sales[2::4])), sales[3::4].tolist()
+        sold = defaultdict(dict)  # sold[store index][product_id] = {cust_id: quantity}, in order of the first sale
+        for (index, product_code), start, end in _runs(zip(sales[0::4], sales[1::4])):
+            sold[index][ids[product_code]] = dict(zip(cust_ids[start:end], quantities[start:end]))
+        for index, store in enumerate(self.stores.values()):
+            store.restore(stocks.get(index, {}), sold.get(index, {}))
+
+    def close(self):
+        """ close the files kept open for ingest """
+        for tail in self.tails.values():
+            tail.close()
+
+    def tail(self, interval=60, rounds=None):
+        """ call ingest every interval seconds, rounds times or forever if rounds is None """
+        count = 0
+        while rounds is None or count < rounds:
+            self.ingest()
+            count += 1
+            if rounds is None or count < rounds:
+                time.sleep(interval)
 
 
     # Print summary information as tables
@@ -117,19 +785,107 @@ class Ecommerce:
                 store_pt.add_row(row) #add it to the pt
         return store_pt
 
+    # Queries answered from a SalesIndex instead of scanning every store and customer
+    def build_index(self):
+        """ build the SalesIndex from the current state and attach it to the stores, which keep it up to date from then on """
+        index = SalesIndex()
+        for store in self.stores.values():
+            for product_id, quantity in store.products.items():
+                index.set_stock(store.store_id, product_id, quantity)
+            for product_id, cust_id, quantity in store.sales_items():
+                index.record_sale(store.store_id, product_id, cust_id, quantity)
+            store.index = index
+        self.index = index
+        return index
+
+    def _require_index(self):
+        return self.index if self.index is not None else self.build_index()
+
+    def low_stock(self, threshold):
+        """ return [(store_id, product_id, quantity)] for every product a store has fewer than threshold units of, lowest first """
+        index = self._require_index()
+        with index.lock:
+            return [(store_id, product_id, quantity) for quantity, (store_id, product_id) in index.stock.below(threshold)]
+
+    def top_products(self, count=100):
+        """ return [(product_id, units sold)] for the count best selling products across all stores """
+        index = self._require_index()
+        with index.lock:
+            return [(product_id, -units) for units, product_id in index.sold.smallest(count)]
+
+    def stores_for_customer(self, cust_id):
+        """ return the ids of the stores cust_id bought from, in order of the first purchase """
+        index = self._require_index()
+        with index.lock:
+            return list(index.customer_stores.get(cust_id, ()))
+
+    def stores_for_product(self, product_id):
+        """ return the ids of the stores that carry product_id """
+        index = self._require_index()
+        with index.lock:
+            return list(index.product_stores.get(product_id, ()))
+
+    # Stream summary information as text, csv or json lines, for reports too big for a PrettyTable
+    def customer_rows(self):
+        """ this generator yields the rows of the customer summary, one customer at a time """
+        for customer in self.customers.values():
+            yield from customer.pt_row()
+
+    def store_rows(self):
+        """ this generator yields the rows of the store summary, one store at a time """
+        for store in self.stores.values():
+            yield from store.pt_row()
+
+    def customer_report(self, stream=None, fmt='auto', **options):
+        """ write the customer summary to stream, see write_report. top=N keeps the N largest quantities """
+        return self._stage('customer_report', None, write_report, Customer.pt_header(self), self.customer_rows(), stream, fmt, key=itemgetter(2), **options)
+
+    def store_report(self, stream=None, fmt='auto', **options):
+        """ write the store summary to stream, see write_report. top=N keeps the N best selling products """
+        return self._stage('store_report', None, write_report, Store.pt_header(self), self.store_rows(), stream, fmt, key=itemgetter(3), **options)
+
+    def memory_usage(self):
+        """ return the approximate number of bytes held by the customers and the stores """
+        seen = set() # objects shared between stores (e.g. the interner) are only counted once
+        return {'customers': deep_sizeof(self.customers, seen), 'stores': deep_sizeof(self.stores, seen)}
+
 class Customer:
     """ Keeps track of all information concerning customers, 
     including what happens when a customer takes a new course 
     """
+    __slots__ = ('cust_id', 'name', '_products')  # no per-instance __dict__: there can be tens of millions of customers
+
     def __init__(self, cust_id, name):
-        self.cust_id = cust_id
+        self.cust_id = sys.intern(cust_id)
         self.name = name
         
-        self.products = defaultdict(int) #self.products[product] = qty
+        self._products = None # the products dict is only allocated once the customer buys something
+
+    @property
+    def products(self):
+        """ self.products[product] = qty """
+        if self._products is None:
+            self._products = defaultdict(int)
+        return self._products
 
     def buy_product(self, product_id, quantity):
         """ note that the customer bought a product"""
-        self.products[product_id] += int(quantity)
+        products = self.products
+        if product_id not in products:
+            product_id = sys.intern(product_id) # every customer's dict shares one copy of the id
+        products[product_id] += int(quantity)
+
+    def add_purchases(self, purchases):
+        """ note {product_id: quantity} bought at once, in order of purchase. Same as buy_product for each """
+        if self._products is None:
+            self._products = defaultdict(int, purchases)
+        else:
+            for product_id, quantity in purchases.items():
+                self.buy_product(product_id, quantity)
+
+    def purchase_items(self):
+        """ return the (product_id, quantity) pairs bought so far, without allocating the products dict """
+        return self._products.items() if self._products is not None else ()
              
     def pt_header(self):
         """ return a list of the fields in the prettytable """
@@ -137,7 +893,7 @@ class Customer:
 
     def pt_row(self):
         """ this generator yields the rows that go into the Customer PrettyTable """
-        for product_id, quantity in self.products.items():
+        for product_id, quantity in self.purchase_items():
             yield [self.name, product_id, quantity]
 
                 
@@ -145,27 +901,91 @@ class Store:
     """ Keeps track of all information concerning Stores, 
     including what happens to the store when a customer buys a product 
     """
+    __slots__ = ('store_id', 'name', 'products', 'sales', 'units_sold', 'customer_index', 'index')
+
     def __init__(self, store_id, name):
-        self.store_id = store_id
+        self.store_id = sys.intern(store_id)
         self.name = name
 
         self.products = defaultdict(int)  # self.products[product_id] = inventory_qty
-        self.sales = defaultdict(lambda: defaultdict(int))
+        self.sales = dict()  # self.sales[product_id][cust_id] = quantity sold, the inner dict is created on the first sale
+        # running aggregates kept up to date by sell_product, so pt_row doesn't have to re-sum self.sales
+        self.units_sold = dict()  # self.units_sold[product_id] = units sold to all customers
+        self.customer_index = dict()  # self.customer_index[product_id] = sorted ids of the customers who bought it, None until pt_row sorts them after a new one
+        self.index = None  # SalesIndex told about every stock change and sale, once Ecommerce.build_index has been called
 
     def add_product(self, product_id, quantity=0):
         """adds products from inventory"""
         self.products[product_id] += int(quantity) #quantity is brought in from the file reader as a string, force it into an int to perform math addition
+        if self.index is not None:
+            self.index.set_stock(self.store_id, product_id, self.products[product_id])
 
     def sell_product(self, product_id, quantity, cust_id):
         """ tell the store that a Customer bought a product """
-        self.products[product_id] -= int(quantity)
-        self.sales[product_id][cust_id] += int(quantity) #keep track of what sold and to who. Necessary for store summary table.
+        quantity = int(quantity)
+        sales_info = self.sales.get(product_id)
+        if sales_info is None: # first sale of this product
+            product_id = sys.intern(product_id)
+            sales_info = self.sales[product_id] = dict()
+            self.units_sold[product_id] = 0
+        self.products[product_id] -= quantity
+        if cust_id in sales_info:
+            sales_info[cust_id] += quantity #keep track of what sold and to who. Necessary for store summary table.
+        else: # a new customer for this product
+            cust_id = sys.intern(cust_id)
+            self.customer_index[product_id] = None # sorted again when a report needs it, so a sale stays O(1)
+            sales_info[cust_id] = quantity
+        self.units_sold[product_id] += quantity
+        if self.index is not None:
+            self.index.set_stock(self.store_id, product_id, self.products[product_id])
+            self.index.record_sale(self.store_id, product_id, cust_id, quantity)
+
+    def add_sales(self, product_id, sales, units=None):
+        """ tell the store that customers bought {cust_id: quantity} of a product, in order of purchase, units in all
+        if it is already known. Same as sell_product for each, but a product's first sales are stored as they are """
+        sales_info = self.sales.get(product_id)
+        if sales_info is not None or self.index is not None:
+            for cust_id, quantity in sales.items():
+                self.sell_product(product_id, quantity, cust_id)
+            return
+        if units is None:
+            units = sum(sales.values())
+        self.products[product_id] -= units
+        product_id = sys.intern(product_id)
+        self.sales[product_id] = dict(sales)
+        self.units_sold[product_id] = units
+        self.customer_index[product_id] = None
+
+    def restore(self, stock, sales):
+        """ set the state of a store that has no stock or sales yet, as saved by a snapshot:
+        stock = {product_id: inventory_qty} and sales = {product_id: {cust_id: quantity}}, in order of the first sale """
+        self.products = defaultdict(int, stock)
+        self.sales = sales
+        self.units_sold = {product_id: sum(sales_info.values()) for product_id, sales_info in sales.items()}
+        self.customer_index = dict.fromkeys(sales)  # sorted when pt_row needs them
+
+    def customer_count(self, product_id):
+        """ number of distinct customers who bought product_id """
+        return len(self.sales.get(product_id, ()))
+
+    def sales_items(self):
+        """ yield (product_id, cust_id, quantity) for every product sold to a customer, in order of the first sale """
+        for product_id, sales_info in self.sales.items():
+            for cust_id, quantity in sales_info.items():
+                yield product_id, cust_id, quantity
 
     def pt_header(self):
         return ['Store', 'Products', 'Customers', 'Quantity Sold']
 
     def pt_row(self):
-        """ this generator yields the rows that go into the Store PrettyTable """
+        """ this generator yields the rows that go into the Store PrettyTable, straight from the running aggregates """
+        for product_id, cust_list in self.customer_index.items(): # same order as self.sales: first sale of each product
+            if cust_list is None:
+                cust_list = self.customer_index[product_id] = sorted(self.sales[product_id])
+            yield [self.name, product_id, list(cust_list), self.units_sold[product_id]]
+
+    def recompute_rows(self):
+        """ the same rows as pt_row, re-summed from self.sales. Kept to check and benchmark the aggregates """
         product_qty = 0
         cust_list = []
         for product_id, sales_info in self.sales.items():
@@ -177,12 +997,1565 @@ class Store:
             cust_list = []
         
 
+def settle_requests(stock, custs, quantities, products, stores, in_stock=False):
+    """ settle purchase requests given as columns in file order, where stock[(store_id, product_id)] = units on hand.
+    Every request gets min(quantity, units left), so per (store, product) the requests are filled in full until the
+    running total requested passes the stock: one sort groups the pairs, a cumulative sum and a bisection per pair
+    find that point, and the units received are slices of the requests instead of a loop over them.
+    Returns (in_stock, received, sales): the stock seen (only with in_stock=True, otherwise None) and the
+    units received by each request, in file order, and
+    sales[(store_id, product_id)] = {cust_id: units}, pairs and customers in order of their first request.
+    This is a module level function so that a process pool can run it.
+    """
+    count = len(quantities)
+    first = dict()  # first[(store_id, product_id)] = row of its first request
+    pair_rows = list(map(first.setdefault, zip(stores, products), range(count)))
+    order = sorted(range(count), key=pair_rows.__getitem__)  # stable, so each pair's requests stay in file order
+    starts = list(accumulate(Counter(pair_rows).values(), initial=0))  # the pairs' requests are order[starts[i]:starts[i + 1]]
+    wanted = list(map(quantities.__getitem__, order))
+    requested = list(accumulate(wanted))  # requested[i] = units asked for by the sorted requests up to i
+    exact = min(wanted, default=0) >= 0  # negative requests break the running total, see below
+
+    before, received = [], []
+    for pair, start, end in zip(first, starts, starts[1:]):
+        units = stock.get(pair, 0)
+        if not exact or units < 0: # same steps as the sequential loop
+            for quantity in wanted[start:end]:
+                before.append(units)
+                received.append(min(quantity, units))
+                units -= received[-1]
+            continue
+        base = requested[start - 1] if start else 0
+        cut = bisect_right(requested, base + units, start, end)  # the first request that can't get all it asked for
+        if in_stock:
+            before.extend(map(sub, repeat(base + units), chain((base,), requested[start:min(cut, end - 1)])))
+            before.extend(repeat(0, end - cut - 1))
+        received.extend(wanted[start:cut])
+        if cut < end:
+            received.append(base + units - (requested[cut - 1] if cut > start else base))
+            received.extend(repeat(0, end - cut - 1))
+
+    sorted_custs = list(map(custs.__getitem__, order))
+    sales = {pair: _tally(sorted_custs[start:end], received[start:end]) for pair, start, end in zip(first, starts, starts[1:])}
+    received_rows = [0] * count
+    deque(map(received_rows.__setitem__, order, received), maxlen=0) # back to file order
+    if in_stock:
+        in_stock = [0] * count
+        deque(map(in_stock.__setitem__, order, before), maxlen=0)
+    else:
+        in_stock = None
+    return in_stock, received_rows, sales
+
+
+def tally_purchases(custs, products, received):
+    """ return bought[cust_id] = {product_id: units} for columns of requests in file order,
+    products in order of the customer's first purchase """
+    bought = dict()
+    for cust_id, product_id, units in zip(custs, products, received):
+        purchases = bought.get(cust_id)
+        if purchases is None:
+            bought[cust_id] = {product_id: units}
+        elif product_id in purchases:
+            purchases[product_id] += units
+        else:
+            purchases[product_id] = units
+    return bought
+
+
+def settle_shard(stock, custs, quantities, products, store_id, positions, in_stock=False):
+    """ settle the purchase requests of one store, given as columns in file order, where stock[(store_id, product_id)]
+    = units on hand and positions[i] = row of request i in the whole file. Runs settle_requests and then sums up the
+    store's sales, so the process that sent the shard only has to write them.
+    Returns (in_stock, received, sales, units_sold): the first two per request like settle_requests,
+    sales[row] = {row: units} and units_sold[row] = units sold to all customers, where a row stands for the id of the
+    product, or the customer, in that row of the file: ids sent back by a worker would be new copies of the strings.
+    This is a module level function so that a process pool can run it.
+    """
+    in_stock, received, sales = settle_requests(stock, custs, quantities, products, repeat(store_id), in_stock)
+    cust_rows, product_rows = dict(), dict()  # cust_rows[cust_id] = a row of the customer's
+    deque(map(cust_rows.setdefault, custs, positions), maxlen=0)
+    deque(map(product_rows.setdefault, products, positions), maxlen=0)
+    sales = {product_rows[product_id]: dict(zip(map(cust_rows.__getitem__, sold), sold.values())) for (_, product_id), sold in sales.items()}
+    units_sold = {row: sum(sold.values()) for row, sold in sales.items()}
+    return in_stock, received, sales, units_sold
+
+
+def _tally(keys, units):
+    """ return {key: total units} in order of the first appearance of each key """
+    totals = dict(zip(keys, units))
+    if len(totals) < len(keys): # a repeated key: dict() kept its first position but only its last units
+        totals = dict.fromkeys(totals, 0)
+        for key, quantity in zip(keys, units):
+            totals[key] += quantity
+    return totals
+
+
+def _runs(keys):
+    """ return (key, start, end) for each run of equal keys, in order, when every key makes up a single run """
+    counts = Counter(keys)
+    starts = list(accumulate(counts.values(), initial=0))
+    return zip(counts, starts, starts[1:])
+
+
+def settle_store(stock, requests):
+    """ settle the purchase requests of one store, where stock[product_id] = units on hand and
+    requests = [(position, cust_id, product_id, quantity)] in file order. Every request gets min(quantity, units left).
+    Returns (received, in_stock, bought, sold): the units received and the stock seen by each request,
+    bought[(cust_id, product_id)] = [position of the first purchase, units] and sold[(product_id, cust_id)] = units.
+    This is a module level function so that a process pool can run it.
+    """
+    groups = defaultdict(list)  # groups[product_id] = indexes into requests, in file order
+    for index, (_, _, product_id, _) in enumerate(requests):
+        groups[product_id].append(index)
+
+    received = array('q', bytes(8 * len(requests)))
+    in_stock = array('q', bytes(8 * len(requests)))
+    for product_id, indexes in groups.items():
+        # left[i] is the stock after the first i requests: each request takes min(requested, left)
+        left = list(accumulate([requests[index][3] for index in indexes], lambda stock, wanted: stock - min(wanted, stock), initial=stock.get(product_id, 0)))
+        for index, before, after in zip(indexes, left, left[1:]):
+            in_stock[index] = before
+            received[index] = before - after
+
+    bought = dict()
+    sold = defaultdict(int)  # in order of the first sale, like Store.sales
+    for (position, cust_id, product_id, _), units in zip(requests, received):
+        tally = bought.get((cust_id, product_id))
+        if tally is None:
+            bought[cust_id, product_id] = [position, units]
+        else:
+            tally[1] += units
+        sold[product_id, cust_id] += units
+    return received, in_stock, bought, dict(sold)
+
+
+class TransactionLog:
+    """ Collects the purchase events of import_transactions and writes them in chunks instead of one print per row.
+    mode is 'text' (the original "Customer ... wants ..." lines), 'jsonl' (one JSON object per line) or 'off'.
+    Only every sample_every-th event is written. While the log is on it also counts requested, fulfilled
+    and short-shipped units per store; when it is off import_transactions doesn't call it at all.
+    """
+    MODES = ('text', 'jsonl', 'off')
+
+    def __init__(self, mode='text', stream=None, sample_every=1, buffer_size=10000):
+        if mode not in self.MODES:
+            raise ValueError("Unknown transaction log mode", mode, "expected one of", self.MODES)
+        self.mode = mode
+        self.stream = stream  # None means whatever sys.stdout is when the buffer is flushed
+        self.sample_every = sample_every
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.events = 0
+        self.counters = defaultdict(lambda: [0, 0])  # self.counters[store_id] = [units requested, units fulfilled]
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def record(self, cust_id, quantity, product_id, store_id, in_stock, received):
+        """ note that cust_id asked store_id for quantity of product_id and received some of it """
+        requested = int(quantity)
+        counter = self.counters[store_id]
+        counter[0] += requested
+        counter[1] += received
+
+        self.events += 1
+        if self.events % self.sample_every:
+            return
+        if self.mode == 'jsonl':
+            self.buffer.append(json.dumps({'cust_id': cust_id, 'product_id': product_id, 'store_id': store_id,
+                                           'requested': requested, 'in_stock': in_stock, 'received': received}) + '\n')
+        else:
+            self.buffer.append("Customer {} wants {} of {}. Store {} has {} in stock. Customer will recieve {}\n".format(cust_id, quantity, product_id, store_id, in_stock, received))
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """ write out the buffered events """
+        if self.buffer:
+            stream = sys.stdout if self.stream is None else self.stream
+            stream.write(''.join(self.buffer))
+            self.buffer = []
+
+    def summary(self):
+        """ return {store_id: {'requested': units, 'fulfilled': units, 'short': units}} """
+        return {store_id: {'requested': requested, 'fulfilled': fulfilled, 'short': requested - fulfilled}
+                for store_id, (requested, fulfilled) in self.counters.items()}
+
+    def pt_header(self):
+        return ['Store', 'Requested', 'Fulfilled', 'Short Shipped']
+
+    def pt(self):
+        """ create a pretty table with the per store summary """
+        summary_pt = PrettyTable()
+        summary_pt.field_names = self.pt_header()
+        for store_id, counts in self.summary().items():
+            summary_pt.add_row([store_id, counts['requested'], counts['fulfilled'], counts['short']])
+        return summary_pt
+
+
+class HyperLogLog:
+    """ Approximate number of distinct items in 2**precision one-byte registers, with a standard error of about
+    1.04 / sqrt(2**precision). Items are hashed with hash(), so sketches can only be merged within one process.
+    """
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, item):
+        hashed = hash((item,)) & 0xFFFFFFFFFFFFFFFF # the tuple hash also mixes the bits of small ints
+        index = hashed & ((1 << self.precision) - 1)
+        rank = 64 - self.precision - (hashed >> self.precision).bit_length() + 1 # position of the first 1 bit
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        """ add the items of other (a sketch of the same precision) to this one """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def estimate(self):
+        """ return the approximate number of distinct items added """
+        m = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros: # few items: linear counting is more accurate
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+
+class CountMinSketch:
+    """ Approximate total weight per item in depth rows of width counters. An estimate is never below the true
+    total, and is above it by at most 2/width of the total weight with probability 1 - 1/2**depth.
+    """
+    def __init__(self, width=2048, depth=4):
+        self.width = width
+        self.rows = [array('q', bytes(8 * width)) for _ in range(depth)]
+
+    def add(self, item, weight=1):
+        for row_number, row in enumerate(self.rows):
+            row[hash((row_number, item)) % self.width] += weight
+
+    def merge(self, other):
+        """ add the counts of other (a sketch of the same shape) to this one """
+        for row, other_row in zip(self.rows, other.rows):
+            for column, count in enumerate(other_row):
+                row[column] += count
+        return self
+
+    def estimate(self, item):
+        return min(row[hash((row_number, item)) % self.width] for row_number, row in enumerate(self.rows))
+
+
+class SpaceSaving:
+    """ Units and number of purchases per key in at most capacity counters. Totals are exact until more than
+    capacity keys are seen; after that a new key takes over the counter with the fewest units and inherits them,
+    so a total can only be overestimated, by at most its error. The heavy hitters are always kept.
+    """
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self.counters = dict()  # self.counters[key] = [units, purchases, error]
+        self.heap = None  # (units, key) of every counter, with stale entries, once the table is full
+
+    def add(self, key, units, purchases=1, error=0):
+        counter = self.counters.get(key)
+        if counter is None:
+            if len(self.counters) >= self.capacity:
+                if self.heap is None:
+                    self.heap = [(entry[0], old_key) for old_key, entry in self.counters.items()]
+                    heapq.heapify(self.heap)
+                while True: # skip entries for keys that were evicted or have grown since they were pushed
+                    floor, old_key = heapq.heappop(self.heap)
+                    smallest = self.counters.get(old_key)
+                    if smallest is not None and smallest[0] == floor:
+                        break
+                del self.counters[old_key]
+                error += floor
+                units += floor
+            counter = self.counters[key] = [0, 0, 0]
+        counter[0] += units
+        counter[1] += purchases
+        counter[2] += error
+        if self.heap is not None:
+            heapq.heappush(self.heap, (counter[0], key))
+            if len(self.heap) > 4 * self.capacity: # drop the stale entries
+                self.heap = [(entry[0], old_key) for old_key, entry in self.counters.items()]
+                heapq.heapify(self.heap)
+
+    def merge(self, other):
+        for key, (units, purchases, error) in other.counters.items():
+            self.add(key, units, purchases, error)
+        return self
+
+
+class _WindowBucket:
+    """ The purchases of one tumbling window of SalesWindows """
+    __slots__ = ('start', 'tables', 'customers', 'store_customers', 'products')
+
+    def __init__(self, start, capacity, precision, count_min):
+        self.start = start
+        self.tables = {dimension: SpaceSaving(capacity) for dimension in SalesWindows.DIMENSIONS}
+        self.customers = HyperLogLog(precision)  # distinct customers in all stores
+        self.store_customers = defaultdict(lambda: HyperLogLog(precision))  # distinct customers per store
+        self.products = CountMinSketch(*count_min) if count_min is not None else None  # units per product
+
+
+class SalesWindows:
+    """ Sliding and tumbling window totals of the purchases settled by import_transactions, ingest and OrderEngine.
+    The data files have no timestamps, so each purchase is stamped with clock() when it is recorded: its arrival
+    time by default, or with clock=None its sequence number, so windows are measured in purchases instead of seconds.
+    Time is cut into tumbling windows of bucket_size and only the last buckets of them are kept; a sliding window
+    adds up the buckets it covers, so its edges are rounded to whole buckets. Each bucket has units and purchases
+    per store, product and customer in SpaceSaving tables of at most capacity keys, HyperLogLogs of the distinct
+    customers, and optionally a CountMinSketch (width, depth) of units per product, so memory stays bounded.
+    """
+    DIMENSIONS = ('store', 'product', 'customer')
+
+    def __init__(self, bucket_size=60, buckets=60, capacity=1000, precision=10, clock=time.time, count_min=None):
+        self.bucket_size = bucket_size
+        self.capacity = capacity
+        self.precision = precision
+        self.clock = clock
+        self.count_min = count_min
+        self.buckets = deque(maxlen=buckets)  # oldest first; the last one is still open
+        self.events = 0
+
+    def now(self):
+        return self.events if self.clock is None else self.clock()
+
+    def record(self, cust_id, product_id, store_id, received):
+        """ note that cust_id received units of product_id from store_id """
+        self.events += 1
+        start = self.now() // self.bucket_size * self.bucket_size
+        if not self.buckets or start > self.buckets[-1].start: # a purchase stamped in the past goes to the open bucket
+            self.buckets.append(_WindowBucket(start, self.capacity, self.precision, self.count_min))
+        bucket = self.buckets[-1]
+        tables = bucket.tables
+        tables['store'].add(store_id, received)
+        tables['product'].add(product_id, received)
+        tables['customer'].add(cust_id, received)
+        bucket.customers.add(cust_id)
+        bucket.store_customers[store_id].add(cust_id)
+        if bucket.products is not None:
+            bucket.products.add(product_id, received)
+
+    def _covered(self, seconds):
+        """ the buckets that overlap the last seconds (or purchases), all of them if seconds is None """
+        if seconds is None:
+            return list(self.buckets)
+        since = self.now() - seconds
+        return [bucket for bucket in self.buckets if bucket.start + self.bucket_size > since]
+
+    def totals(self, dimension, seconds=None):
+        """ return {key: (units, purchases)} for dimension 'store', 'product' or 'customer' over a sliding window """
+        table = SpaceSaving(self.capacity)
+        for bucket in self._covered(seconds):
+            table.merge(bucket.tables[dimension])
+        return {key: (units, purchases) for key, (units, purchases, _) in table.counters.items()}
+
+    def top(self, dimension, n=10, seconds=None):
+        """ return the n keys of dimension with the most units over a sliding window, as [(key, units, purchases)] """
+        return [(key, units, purchases) for key, (units, purchases) in heapq.nlargest(n, self.totals(dimension, seconds).items(), key=lambda item: item[1][0])]
+
+    def tumbling(self, dimension):
+        """ return [(start, {key: (units, purchases)})] for each kept tumbling window, oldest first """
+        return [(bucket.start, {key: (units, purchases) for key, (units, purchases, _) in bucket.tables[dimension].counters.items()})
+                for bucket in self.buckets]
+
+    def distinct_customers(self, store_id=None, seconds=None):
+        """ return the approximate number of distinct customers, in one store or all of them, over a sliding window """
+        merged = HyperLogLog(self.precision)
+        for bucket in self._covered(seconds):
+            if store_id is None:
+                merged.merge(bucket.customers)
+            elif store_id in bucket.store_customers:
+                merged.merge(bucket.store_customers[store_id])
+        return merged.estimate()
+
+    def product_units(self, product_id, seconds=None):
+        """ return the Count-Min estimate of the units of product_id over a sliding window, an upper bound """
+        if self.count_min is None:
+            raise ValueError("SalesWindows was created without count_min")
+        return sum(bucket.products.estimate(product_id) for bucket in self._covered(seconds))
+
+    def pt_header(self, dimension):
+        return [dimension.capitalize(), 'Units', 'Purchases']
+
+    def pt(self, dimension='store', n=10, seconds=None):
+        """ create a pretty table with the top n keys of dimension over a sliding window """
+        window_pt = PrettyTable()
+        window_pt.field_names = self.pt_header(dimension)
+        for row in self.top(dimension, n, seconds):
+            window_pt.add_row(list(row))
+        return window_pt
+
+
+class LazyMap(Mapping):
+    """ Read-only dict whose values are only built, by load(key), the first time their key is looked up.
+    keys() is a function returning the keys in order, so even the key index is only built when first needed
+    """
+    def __init__(self, keys, load):
+        self._keys = keys
+        self._load = load
+        self.loaded = dict()  # self.loaded[key] = value built so far
+
+    def __getitem__(self, key):
+        value = self.loaded.get(key)
+        if value is None:
+            if key not in self._keys():
+                raise KeyError(key)
+            value = self.loaded[key] = self._load(key)
+        return value
+
+    def __contains__(self, key):
+        return key in self._keys() # Mapping's version would look the key up, and build the value
+
+    def __iter__(self):
+        return iter(self._keys())
+
+    def __len__(self):
+        return len(self._keys())
+
+
+def scan_lines(file_name, fields_per_line, separator, header=False):
+    """ this generator yields (byte offset, fields) for the lines of file_name. Like the import methods it prints
+    the ValueError for the first line with the wrong number of fields and stops there. A missing file yields nothing.
+    """
+    try:
+        fp = open(file_name, 'rb')
+    except FileNotFoundError:
+        print("can't open", file_name)
+        return
+    with fp:
+        offset = 0
+        for line_number, line in enumerate(fp, 1):
+            fields = line.decode().rstrip('\n\r').split(separator)
+            if len(fields) != fields_per_line:
+                print(ValueError(file_name, "has", len(fields), "fields in", line_number, "but expected", fields_per_line))
+                return
+            if not (header and line_number == 1):
+                yield offset, fields
+            offset += len(line)
+
+
+def _read_only(name):
+    """ return a method that refuses the write operation name, for the modes of Ecommerce that can't do it """
+    def refuse(self, *args, **options):
+        raise NotImplementedError(type(self).__name__, "is read-only,", name, "needs Ecommerce")
+    refuse.__name__ = name
+    return refuse
+
+
+class LazyEcommerce(Ecommerce):
+    """ Ecommerce that reads only what is asked for. Each file is scanned once, the first time it is needed, into
+    an index of line offsets by store (and customer). A store's products, inventory and transactions are read and
+    settled the first time the store is looked up; a customer is built from the stores they bought from.
+    Stock only moves within a store, so the results are the same as loading everything. This mode is read-only:
+    the imports, settlement, ingest and snapshots raise NotImplementedError, and OrderEngine refuses it.
+    """
+    def __init__(self, dir_path, transaction_log=None, metrics=None):
+        self._init_state(dir_path, False, TransactionLog('off') if transaction_log is None else transaction_log, metrics)
+        self.line_index = dict()  # self.line_index[file name] = the offsets of its lines, see _file_index
+        self.purchases = dict()  # self.purchases[store_id][cust_id] = [(position, product_id, units)] settled by that store
+        self.customers = LazyMap(lambda: self._file_index("customers.txt"), lambda cust_id: self._stage('load_customer', None, self._load_customer, cust_id))
+        self.stores = LazyMap(lambda: self._file_index("stores.txt"), lambda store_id: self._stage('load_store', None, self._load_store, store_id))
+
+    def _file_index(self, file_name):
+        """ return the index of file_name, scanning it on first use """
+        index = self.line_index.get(file_name)
+        if index is None:
+            index = self.line_index[file_name] = self._stage('index_' + file_name.split('.')[0], file_name, self._scan_file, file_name)
+        return index
+
+    def _scan_file(self, file_name):
+        """ build the index of file_name. customers.txt and stores.txt map each id to the offset of its line; the
+            other files map a store id to the offsets of its lines (array of int64), and transactions.txt also
+            gives each customer the stores they bought from, in order of the first purchase.
+        """
+        path = os.path.join(self.dir_path, file_name)
+        if file_name == "customers.txt":
+            index = {fields[0]: offset for offset, fields in scan_lines(path, 2, ',')}
+        elif file_name == "stores.txt":
+            index = {fields[0]: offset for offset, fields in scan_lines(path, 2, '*', True)}
+        else:
+            fields_per_line, header, store_field = {"products.txt": (3, False, 1), "inventory.txt": (3, True, 0), "transactions.txt": (4, True, 3)}[file_name]
+            index = defaultdict(lambda: array('q'))
+            customer_stores = defaultdict(dict)
+            for offset, fields in scan_lines(path, fields_per_line, '|', header):
+                index[fields[store_field]].append(offset)
+                if file_name == "transactions.txt":
+                    customer_stores[fields[0]][fields[3]] = None
+            index = dict(index)
+            if file_name == "transactions.txt":
+                self.line_index['customer_stores'] = dict(customer_stores)
+        return index
+
+    def _read_lines(self, file_name, offsets, separator):
+        """ return the fields of the lines of file_name that start at offsets """
+        rows = []
+        if offsets:
+            with open(os.path.join(self.dir_path, file_name), 'rb') as fp:
+                for offset in offsets:
+                    fp.seek(offset)
+                    rows.append(fp.readline().decode().rstrip('\n\r').split(separator))
+        return rows
+
+    def _load_customer(self, cust_id):
+        """ build a Customer from its line and the purchases settled by the stores it bought from """
+        (_, name), = self._read_lines("customers.txt", [self._file_index("customers.txt")[cust_id]], ',')
+        customer = Customer(cust_id, name)
+        self._file_index("transactions.txt")
+        purchases = []
+        for store_id in self.line_index['customer_stores'].get(cust_id, ()):
+            if store_id not in self.stores: # transactions for a store that isn't in stores.txt
+                continue
+            self.stores[store_id] # builds and settles the store the first time, which fills self.purchases[store_id]
+            purchases.extend(self.purchases[store_id].get(cust_id, ()))
+        for _, product_id, units in sorted(purchases): # the same order as reading the whole transactions file
+            customer.buy_product(product_id, units)
+        return customer
+
+    def _load_store(self, store_id):
+        """ build a Store from its own lines of products, inventory and transactions """
+        (_, name), = self._read_lines("stores.txt", [self._file_index("stores.txt")[store_id]], '*')
+        store = Store(store_id, name)
+        for product_id, _, _ in self._read_lines("products.txt", self._file_index("products.txt").get(store_id), '|'):
+            store.add_product(product_id)
+        for _, quantity, product_id in self._read_lines("inventory.txt", self._file_index("inventory.txt").get(store_id), '|'):
+            store.add_product(product_id, quantity)
+
+        offsets = self._file_index("transactions.txt").get(store_id, ())
+        requests = [(offset, cust_id, product_id, int(quantity))
+                    for offset, (cust_id, quantity, product_id, _) in zip(offsets, self._read_lines("transactions.txt", offsets, '|'))]
+        stock = {product_id: store.products.get(product_id, 0) for product_id in dict.fromkeys(request[2] for request in requests)}
+        _, _, bought, sold = settle_store(stock, requests)
+        for (product_id, cust_id), units in sold.items():
+            store.sell_product(product_id, units, cust_id)
+        purchases = defaultdict(list)
+        for (cust_id, product_id), (position, units) in bought.items():
+            purchases[cust_id].append((position, product_id, units))
+        self.purchases[store_id] = dict(purchases)
+        return store
+
+    def loaded(self):
+        """ return how many customers and stores have been built so far, out of how many """
+        return {'customers': (len(self.customers.loaded), len(self.customers)), 'stores': (len(self.stores.loaded), len(self.stores))}
+
+    # everything that would change the state, which is rebuilt from the files on demand
+    import_customers = _read_only('import_customers')
+    import_stores = _read_only('import_stores')
+    import_products = _read_only('import_products')
+    import_inventory = _read_only('import_inventory')
+    import_transactions = _read_only('import_transactions')
+    settle_transactions = _read_only('settle_transactions')
+    ingest = _read_only('ingest')
+    tail = _read_only('tail')
+    save_snapshot = _read_only('save_snapshot')
+    load_snapshot = _read_only('load_snapshot')
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS customers (cust_id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stores (store_id TEXT PRIMARY KEY, name TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS stock (store_id TEXT NOT NULL, product_id TEXT NOT NULL, quantity INTEGER NOT NULL,
+                                  PRIMARY KEY (store_id, product_id));
+CREATE TABLE IF NOT EXISTS transactions (seq INTEGER PRIMARY KEY, cust_id TEXT NOT NULL, quantity INTEGER NOT NULL,
+                                         product_id TEXT NOT NULL, store_id TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS purchases (cust_id TEXT NOT NULL, product_id TEXT NOT NULL, quantity INTEGER NOT NULL, first INTEGER NOT NULL,
+                                      PRIMARY KEY (cust_id, product_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sales (store_id TEXT NOT NULL, product_id TEXT NOT NULL, cust_id TEXT NOT NULL, quantity INTEGER NOT NULL,
+                                  first INTEGER NOT NULL, PRIMARY KEY (store_id, product_id, cust_id)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS tails (file_name TEXT PRIMARY KEY, inode INTEGER, offset INTEGER NOT NULL, line_number INTEGER NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+CREATE INDEX IF NOT EXISTS sales_by_customer ON sales (cust_id, store_id);
+CREATE INDEX IF NOT EXISTS stock_by_product ON stock (product_id);
+CREATE INDEX IF NOT EXISTS stock_by_quantity ON stock (quantity);
+"""
+
+# Every request takes min(wanted, left), so the stock left after a request is max(stock - units requested so far, 0)
+# and a whole file of transactions settles with one running sum per (store, product) in file order
+SQLITE_SETTLE = """
+CREATE TEMP TABLE settled AS
+SELECT seq, cust_id, quantity, product_id, store_id, in_stock, MIN(quantity, in_stock) AS received
+FROM (SELECT t.seq, t.cust_id, t.quantity, t.product_id, t.store_id,
+             MAX(COALESCE(s.quantity, 0) - (SUM(t.quantity) OVER requested - t.quantity), 0) AS in_stock
+      FROM transactions AS t LEFT JOIN stock AS s ON s.store_id = t.store_id AND s.product_id = t.product_id
+      WHERE t.seq > ?
+      WINDOW requested AS (PARTITION BY t.store_id, t.product_id ORDER BY t.seq ROWS UNBOUNDED PRECEDING))
+"""
+
+
+class _SqliteMap(Mapping):
+    """ Read-only dict over the customers or stores table. Each lookup builds a new Customer or Store from the
+    database with load(key), so it is a copy: changes to it are not saved
+    """
+    def __init__(self, db, table, key, load):
+        self._db = db
+        self._table = table
+        self._key = key
+        self._load = load
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self._load(key)
+
+    def __contains__(self, key):
+        return self._db.execute("SELECT 1 FROM {} WHERE {} = ?".format(self._table, self._key), (key,)).fetchone() is not None
+
+    def __iter__(self):
+        return (key for key, in self._db.execute("SELECT {} FROM {} ORDER BY rowid".format(self._key, self._table)))
+
+    def __len__(self):
+        return self._db.execute("SELECT COUNT(*) FROM {}".format(self._table)).fetchone()[0]
+
+
+class SqliteEcommerce(Ecommerce):
+    """ Ecommerce kept in an SQLite database instead of dicts, so it isn't limited by memory and, with a file as
+    database, survives a restart: load=False opens what an earlier run saved, and ingest continues from where it
+    stopped. The files are bulk loaded with executemany, transactions are settled in SQL (see SQLITE_SETTLE) and
+    the reports stream straight from the database. self.customers and self.stores build Customer and Store copies
+    on lookup, so OrderEngine, snapshots and compact stores need the dict backend.
+    """
+    def __init__(self, dir_path, database=':memory:', load=True, transaction_log=None, metrics=None, analytics=None):
+        self._init_state(dir_path, False, transaction_log, metrics, analytics)
+        self.db = sqlite3.connect(database)
+        self.db.executescript(SQLITE_SCHEMA)
+        self.customers = _SqliteMap(self.db, 'customers', 'cust_id', self._load_customer)
+        self.stores = _SqliteMap(self.db, 'stores', 'store_id', self._load_store)
+        if load:
+            with self.db:
+                for table in ('customers', 'stores', 'stock', 'transactions', 'purchases', 'sales', 'tails', 'meta'):
+                    self.db.execute("DELETE FROM {}".format(table))
+            for file_name in APPEND_ONLY_FILES: # positioned by the imports, where they stopped reading
+                self.tails[file_name] = self._file_tail(file_name)
+            self._stage('import_customers', "customers.txt", self.import_customers, dir_path)
+            self._stage('import_stores', "stores.txt", self.import_stores, dir_path)
+            self._stage('import_products', "products.txt", self.import_products, dir_path)
+            self._stage('import_inventory', "inventory.txt", self.import_inventory, dir_path)
+            self._stage('import_transactions', "transactions.txt", self.import_transactions, dir_path)
+        else:
+            saved = {file_name: (inode, offset, line_number) for file_name, inode, offset, line_number in self.db.execute("SELECT * FROM tails")}
+            for file_name in APPEND_ONLY_FILES:
+                tail = self.tails[file_name] = self._file_tail(file_name, at_end=file_name not in saved)
+                if file_name in saved:
+                    inode, offset, line_number = saved[file_name]
+                    tail.seek(offset, line_number, inode)
+        with self.db:
+            self._save_tails()
+
+    def _save_tails(self):
+        """ note how far the tails have read, in the database transaction of the caller """
+        self.db.executemany("INSERT OR REPLACE INTO tails VALUES (?, ?, ?, ?)",
+                            [(name, tail.inode, tail.offset - len(tail.partial), tail.line_number) for name, tail in self.tails.items()])
+
+    def _bulk_load(self, file_name, fields_per_line, separator, header, statement, reader=file_batches, chunk_size=1 << 18, **options):
+        """ insert the rows of file_name with statement, in one transaction. Nothing is kept between the blocks
+            of chunk_size, so only one block of rows is in memory at a time. Returns the rows read """
+        rows = 0
+        with self.db:
+            try:
+                for batch in reader(file_name, fields_per_line, separator, header, chunk_size=chunk_size, **options):
+                    rows += len(batch)
+                    self.db.executemany(statement, batch)
+            except ValueError as e:
+                print(e) # the rows before the bad line are kept, like the dict backend
+        return rows
+
+    def import_customers(self, dir_path):
+        return self._bulk_load(os.path.join(dir_path, "customers.txt"), 2, ',', False,
+                               "INSERT INTO customers VALUES (?, ?) ON CONFLICT (cust_id) DO UPDATE SET name = excluded.name")
+
+    def import_stores(self, dir_path):
+        return self._bulk_load(os.path.join(dir_path, "stores.txt"), 2, '*', True,
+                               "INSERT INTO stores VALUES (?, ?) ON CONFLICT (store_id) DO UPDATE SET name = excluded.name")
+
+    def import_products(self, dir_path):
+        return self._bulk_load(os.path.join(dir_path, "products.txt"), 3, '|', False,
+                               "INSERT OR IGNORE INTO stock SELECT ?2, ?1, 0 WHERE ?3 IS NOT NULL", mmap_batches) # ?3, the product name, isn't kept
+
+    def import_inventory(self, dir_path):
+        return self._bulk_load(os.path.join(dir_path, "inventory.txt"), 3, '|', True,
+                               "INSERT INTO stock VALUES (?1, ?3, ?2) ON CONFLICT (store_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity",
+                               mmap_batches, int_fields=(1,), tail=self.tails.get('inventory.txt'))
+
+    def import_transactions(self, dir_path, processes=None, batch=False):
+        """ insert the transactions file and settle it in SQL. processes and batch are accepted for the same signature
+            as Ecommerce; settlement is always set based here. Returns the rows read.
+        """
+        rows = self._bulk_load(os.path.join(dir_path, "transactions.txt"), 4, '|', True,
+                               "INSERT INTO transactions (cust_id, quantity, product_id, store_id) VALUES (?, ?, ?, ?)",
+                               mmap_batches, int_fields=(1,), tail=self.tails.get('transactions.txt'))
+        self._settle()
+        return rows
+
+    def settle_transactions(self, transactions, processes=None):
+        """ append (cust_id, quantity, product_id, store_id) rows and settle them """
+        self._settle(transactions=transactions)
+
+    def _settle(self, restock=(), transactions=(), save_tails=False):
+        """ add the (store_id, quantity, product_id) restock rows and append the (cust_id, quantity, product_id, store_id)
+            transaction rows, then settle every transaction added since the last settlement: take the units from stock
+            and add them to the purchases and sales. With save_tails=True the positions of the tails are saved too,
+            all in one database transaction, so after a crash the rows are either applied and skipped by the tails or
+            neither. The purchases are then reported in file order to self.transaction_log and self.analytics, if they are on.
+        """
+        db = self.db
+        saved = db.execute("SELECT value FROM meta WHERE key = 'settled'").fetchone()
+        settled = saved[0] if saved is not None else 0
+        try:
+            with db:
+                db.executemany("INSERT INTO stock VALUES (?1, ?3, ?2) ON CONFLICT (store_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity",
+                               ((store_id, int(quantity), product_id) for store_id, quantity, product_id in restock))
+                db.executemany("INSERT INTO transactions (cust_id, quantity, product_id, store_id) VALUES (?, ?, ?, ?)",
+                               ((cust_id, int(quantity), product_id, store_id) for cust_id, quantity, product_id, store_id in transactions))
+                db.execute("DROP TABLE IF EXISTS temp.settled")
+                db.execute(SQLITE_SETTLE, (settled,))
+                db.execute("""INSERT INTO stock SELECT store_id, product_id, -SUM(received) FROM settled WHERE true GROUP BY store_id, product_id
+                              ON CONFLICT (store_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity""")
+                db.execute("""INSERT INTO purchases SELECT cust_id, product_id, SUM(received), MIN(seq) FROM settled WHERE true GROUP BY cust_id, product_id
+                              ON CONFLICT (cust_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity""")
+                db.execute("""INSERT INTO sales SELECT store_id, product_id, cust_id, SUM(received), MIN(seq) FROM settled WHERE true GROUP BY store_id, product_id, cust_id
+                              ON CONFLICT (store_id, product_id, cust_id) DO UPDATE SET quantity = quantity + excluded.quantity""")
+                db.execute("INSERT OR REPLACE INTO meta SELECT 'settled', COALESCE(MAX(seq), ?) FROM transactions", (settled,))
+                if save_tails:
+                    self._save_tails()
+            if self.transaction_log.enabled or self.analytics is not None:
+                record = self.transaction_log.record if self.transaction_log.enabled else None
+                window = self.analytics.record if self.analytics is not None else None
+                for cust_id, quantity, product_id, store_id, in_stock, received in db.execute(
+                        "SELECT cust_id, quantity, product_id, store_id, in_stock, received FROM settled ORDER BY seq"):
+                    if record is not None:
+                        record(cust_id, quantity, product_id, store_id, in_stock, received)
+                    if window is not None:
+                        window(cust_id, product_id, store_id, received)
+            db.execute("DROP TABLE temp.settled")
+        finally:
+            self.transaction_log.flush()
+
+    def ingest(self):
+        """ apply the inventory and transactions appended to the files since the last load or ingest,
+            restocking first. Returns the number of new rows read from each file.
+        """
+        restock = self.tails['inventory.txt'].read()
+        transactions = self.tails['transactions.txt'].read()
+        self._settle(restock, transactions, save_tails=True)
+        return {'inventory.txt': len(restock), 'transactions.txt': len(transactions)}
+
+    def close(self):
+        """ close the files kept open for ingest and the database """
+        super().close()
+        self.db.close()
+
+    def _load_customer(self, cust_id):
+        """ build a Customer from its row and its purchases """
+        name, = self.db.execute("SELECT name FROM customers WHERE cust_id = ?", (cust_id,)).fetchone()
+        customer = Customer(cust_id, name)
+        for product_id, quantity in self.db.execute("SELECT product_id, quantity FROM purchases WHERE cust_id = ? ORDER BY first", (cust_id,)):
+            customer.buy_product(product_id, quantity)
+        return customer
+
+    def _load_store(self, store_id):
+        """ build a Store from its row, stock and sales """
+        name, = self.db.execute("SELECT name FROM stores WHERE store_id = ?", (store_id,)).fetchone()
+        store = Store(store_id, name)
+        for product_id, quantity in self.db.execute(
+                """SELECT product_id, quantity + (SELECT COALESCE(SUM(quantity), 0) FROM sales
+                                                  WHERE sales.store_id = stock.store_id AND sales.product_id = stock.product_id)
+                   FROM stock WHERE store_id = ? ORDER BY rowid""", (store_id,)):
+            store.add_product(product_id, quantity) # the stock before the sales, which sell_product then takes off
+        for product_id, cust_id, quantity in self.db.execute(
+                """SELECT product_id, cust_id, quantity FROM sales WHERE store_id = ?
+                   ORDER BY MIN(first) OVER (PARTITION BY product_id), first""", (store_id,)):
+            store.sell_product(product_id, quantity, cust_id)
+        return store
+
+    # The queries and reports run in SQL, so they see the data as it is in the database
+    def low_stock(self, threshold):
+        """ return [(store_id, product_id, quantity)] for every product a store has fewer than threshold units of, lowest first """
+        return self.db.execute("SELECT store_id, product_id, quantity FROM stock WHERE quantity < ? ORDER BY quantity, store_id, product_id", (threshold,)).fetchall()
+
+    def top_products(self, count=100):
+        """ return [(product_id, units sold)] for the count best selling products across all stores """
+        return self.db.execute("SELECT product_id, SUM(quantity) AS units FROM sales GROUP BY product_id ORDER BY units DESC, product_id LIMIT ?", (count,)).fetchall()
+
+    def stores_for_customer(self, cust_id):
+        """ return the ids of the stores cust_id bought from, in order of the first purchase """
+        return [store_id for store_id, in self.db.execute("SELECT store_id FROM sales WHERE cust_id = ? GROUP BY store_id ORDER BY MIN(first)", (cust_id,))]
+
+    def stores_for_product(self, product_id):
+        """ return the ids of the stores that carry product_id """
+        return [store_id for store_id, in self.db.execute("SELECT store_id FROM stock WHERE product_id = ? ORDER BY rowid", (product_id,))]
+
+    def customer_rows(self):
+        """ this generator yields the rows of the customer summary straight from the database """
+        for row in self.db.execute("""SELECT c.name, p.product_id, p.quantity FROM customers AS c JOIN purchases AS p ON p.cust_id = c.cust_id
+                                      ORDER BY c.rowid, p.first"""):
+            yield list(row)
+
+    def store_rows(self):
+        """ this generator yields the rows of the store summary straight from the database, one product at a time """
+        sales = self.db.execute("""SELECT st.rowid, st.name, s.product_id, s.cust_id, s.quantity FROM stores AS st JOIN sales AS s ON s.store_id = st.store_id
+                                   ORDER BY st.rowid, MIN(s.first) OVER (PARTITION BY s.store_id, s.product_id), s.cust_id""")
+        for (_, name, product_id), rows in groupby(sales, key=itemgetter(0, 1, 2)):
+            rows = list(rows)
+            yield [name, product_id, [row[3] for row in rows], sum(row[4] for row in rows)]
+
+    def memory_usage(self):
+        """ return the bytes of the database, which holds the customers and the stores """
+        page_count, = self.db.execute("PRAGMA page_count").fetchone()
+        page_size, = self.db.execute("PRAGMA page_size").fetchone()
+        return {'database': page_count * page_size}
+
+
+class Metrics:
+    """ Collects how long each Ecommerce stage takes, the rows and bytes it reads and the net number of memory blocks
+    it allocates. With profile=True a background thread also samples the running stage's stack every interval
+    seconds, to show which lines are hot. Pass one to Ecommerce(metrics=...); without it nothing is measured.
+    """
+    def __init__(self, profile=False, interval=0.001):
+        self.profile = profile
+        self.interval = interval
+        self.stages = dict()  # self.stages[name] = {'calls', 'seconds', 'rows', 'bytes', 'allocated_blocks'}
+        self.samples = Counter()  # self.samples[(stage, file name, line number, function)] = times seen on top of the stack
+
+    def measure(self, name, function, args=(), file_name=None, options=None):
+        """ call function(*args, **options) as stage name and add what it cost. Returns what the function returns """
+        sampler, done = None, threading.Event()
+        if self.profile:
+            sampler = threading.Thread(target=self._sample, args=(name, threading.get_ident(), done), daemon=True)
+            sampler.start()
+        blocks = sys.getallocatedblocks()
+        start = time.perf_counter()
+        try:
+            result = function(*args, **(options or {}))
+        finally:
+            elapsed = time.perf_counter() - start
+            if sampler is not None:
+                done.set()
+                sampler.join()
+        stage = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'rows': 0, 'bytes': 0, 'allocated_blocks': 0})
+        stage['calls'] += 1
+        stage['seconds'] += elapsed
+        stage['allocated_blocks'] += sys.getallocatedblocks() - blocks
+        if isinstance(result, int) and not isinstance(result, bool):
+            stage['rows'] += result
+        if file_name is not None and os.path.exists(file_name):
+            stage['bytes'] += os.path.getsize(file_name)
+        return result
+
+    def _sample(self, name, thread_id, done):
+        """ note the innermost frame of thread_id every self.interval seconds until done is set """
+        while not done.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                code = frame.f_code
+                self.samples[name, code.co_filename, frame.f_lineno, code.co_name] += 1
+
+    def hot_spots(self, count=10):
+        """ return the count most sampled [(stage, file name, line number, function), samples] """
+        return self.samples.most_common(count)
+
+    def report(self):
+        """ return the metrics as a dict, with rows/sec and MB/sec worked out per stage """
+        stages = dict()
+        for name, stage in self.stages.items():
+            seconds = stage['seconds']
+            stages[name] = dict(stage, rows_per_sec=stage['rows'] / seconds if seconds else 0.0,
+                                mb_per_sec=stage['bytes'] / seconds / 1e6 if seconds else 0.0)
+        return {'stages': stages,
+                'hot_spots': [{'stage': stage, 'file': file_name, 'line': line, 'function': function, 'samples': samples}
+                              for (stage, file_name, line, function), samples in self.hot_spots(25)]}
+
+    def export(self, stream):
+        """ write report() to stream as JSON """
+        json.dump(self.report(), stream, indent=2)
+
+    def pt_header(self):
+        return ['Stage', 'Calls', 'Seconds', 'Rows', 'Rows/sec', 'MB/sec', 'Blocks Allocated']
+
+    def pt(self):
+        """ create a pretty table with one row per stage """
+        metrics_pt = PrettyTable()
+        metrics_pt.field_names = self.pt_header()
+        for name, stage in self.report()['stages'].items():
+            metrics_pt.add_row([name, stage['calls'], round(stage['seconds'], 4), stage['rows'], round(stage['rows_per_sec']),
+                                round(stage['mb_per_sec'], 2), stage['allocated_blocks']])
+        return metrics_pt
+
+
+class OrderEngine:
+    """ Settles purchase requests coming from many threads (or asyncio tasks) against a loaded Ecommerce.
+    Reading the stock, taking min(requested, in stock) and selling happen under the store's lock, so two
+    orders can never both take the last units. Customers are updated under one of a fixed set of striped
+    locks; a thread holds at most a store lock and then a customer lock, so there is no deadlock.
+    """
+    def __init__(self, ecommerce, workers=8, customer_stripes=64):
+        if not isinstance(ecommerce.stores, dict): # LazyEcommerce and SqliteEcommerce hand out copies, which would be sold from
+            raise TypeError("OrderEngine needs the stores in memory, not a", type(ecommerce).__name__)
+        self.ecommerce = ecommerce
+        self.store_locks = {store_id: threading.Lock() for store_id in ecommerce.stores}
+        self.customer_locks = [threading.Lock() for _ in range(customer_stripes)]
+        self.log_lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(workers)
+
+    def purchase(self, cust_id, quantity, product_id, store_id):
+        """ settle one request in the calling thread and return the units the customer received """
+        ecommerce = self.ecommerce
+        if ecommerce.interner is not None:
+            product_id = ecommerce.interner.intern(product_id)
+        store = ecommerce.stores[store_id]
+        customer = ecommerce.customers[cust_id]
+        with self.store_locks[store_id]:
+            in_stock = store.products[product_id]
+            received = min(int(quantity), in_stock) # same rule as import_transactions
+            store.sell_product(product_id, received, cust_id)
+        with self.customer_locks[hash(cust_id) % len(self.customer_locks)]:
+            customer.buy_product(product_id, received)
+        if ecommerce.transaction_log.enabled or ecommerce.analytics is not None:
+            with self.log_lock:
+                if ecommerce.transaction_log.enabled:
+                    ecommerce.transaction_log.record(cust_id, quantity, product_id, store_id, in_stock, received)
+                if ecommerce.analytics is not None:
+                    ecommerce.analytics.record(cust_id, product_id, store_id, received)
+        return received
+
+    def submit(self, cust_id, quantity, product_id, store_id):
+        """ queue a request on the thread pool and return a Future with the units received """
+        return self.pool.submit(self.purchase, cust_id, quantity, product_id, store_id)
+
+    async def purchase_async(self, cust_id, quantity, product_id, store_id):
+        """ settle a request on the thread pool without blocking the event loop """
+        return await asyncio.get_running_loop().run_in_executor(self.pool, self.purchase, cust_id, quantity, product_id, store_id)
+
+    def close(self):
+        """ wait for the queued requests and stop the thread pool """
+        self.pool.shutdown(wait=True)
+        self.ecommerce.transaction_log.flush()
+
+
+def load_test(dir_path, concurrency_levels=(1, 2, 4, 8, 16)):
+    """ replay transactions.txt through an OrderEngine from a growing number of client threads, each level against
+    a fresh copy of the inventory. Prints and returns {threads: (orders/sec, p99 latency in seconds)}, and checks
+    that no store sold more than it had.
+    """
+    requests = [row for batch in file_batches(os.path.join(dir_path, "transactions.txt"), 4, '|', True) for row in batch]
+    results = dict()
+    for threads in concurrency_levels:
+        ecommerce = Ecommerce(dir_path, transaction_log=TransactionLog('off'), transactions=False)
+        engine = OrderEngine(ecommerce, workers=threads)
+        latencies = [[] for _ in range(threads)]
+
+        def client(number):
+            for cust_id, quantity, product_id, store_id in requests[number::threads]:
+                start = time.perf_counter()
+                engine.purchase(cust_id, quantity, product_id, store_id)
+                latencies[number].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for future in [engine.pool.submit(client, number) for number in range(threads)]:
+            future.result()
+        elapsed = time.perf_counter() - start
+        engine.close()
+
+        all_latencies = sorted(chain.from_iterable(latencies))
+        p99 = all_latencies[max(0, math.ceil(0.99 * len(all_latencies)) - 1)] if all_latencies else 0.0
+        oversold = [(store_id, product_id) for store_id, store in ecommerce.stores.items() for product_id, quantity in store.products.items() if quantity < 0]
+        results[threads] = (len(requests) / elapsed if elapsed else float('inf'), p99)
+        print("{:>3} threads: {:>10,.0f} orders/sec  p99 {:.1f}us  oversold SKUs: {}".format(threads, results[threads][0], p99 * 1e6, len(oversold)))
+    return results
+
+
+class VersionedHeap:
+    """ Min-heap of (priority, key) where changing the priority of a key pushes a new entry and leaves the old
+    one behind as stale, so updates are O(log n). Queries walk the heap smallest first and skip stale entries,
+    and the heap is rebuilt from the live entries once the stale ones outnumber them. Equal priorities come out
+    in key order, the same as the ORDER BY of the SQLite backend, not in the order they were updated.
+    """
+    def __init__(self):
+        self.heap = []  # (priority, key, version)
+        self.current = dict()  # self.current[key] = (priority, version) of the live entry
+        self.version = 0
+
+    def update(self, key, priority):
+        """ set the priority of key """
+        self.version += 1
+        self.current[key] = (priority, self.version)
+        heapq.heappush(self.heap, (priority, key, self.version))
+        if len(self.heap) > 2 * len(self.current) + 64:
+            self.heap = [(priority, key, version) for key, (priority, version) in self.current.items()]
+            heapq.heapify(self.heap)
+
+    def __iter__(self):
+        """ yield the live (priority, key) pairs in increasing priority, visiting only the part of the heap that is needed """
+        heap, current = self.heap, self.current
+        frontier = [(heap[0], 0)] if heap else []
+        while frontier:
+            (priority, key, version), position = heapq.heappop(frontier)
+            if current[key][1] == version:
+                yield priority, key
+            for child in (2 * position + 1, 2 * position + 2):
+                if child < len(heap):
+                    heapq.heappush(frontier, (heap[child], child))
+
+    def below(self, limit):
+        """ yield the live (priority, key) pairs with priority < limit, smallest first """
+        for priority, key in self:
+            if priority >= limit:
+                return
+            yield priority, key
+
+    def smallest(self, count):
+        """ return the count live (priority, key) pairs with the smallest priority """
+        return list(islice(self, count))
+
+
+class SalesIndex:
+    """ Secondary indexes over all the stores, updated by Store.add_product and Store.sell_product:
+    stock levels and units sold per product in VersionedHeaps, and which stores carry a product or sold to a customer
+    """
+    def __init__(self):
+        self.stock = VersionedHeap()  # key (store_id, product_id), priority = units in stock
+        self.units_sold = defaultdict(int)  # self.units_sold[product_id] = units sold by all stores
+        self.sold = VersionedHeap()  # key product_id, priority = -units sold, so the best sellers come first
+        self.product_stores = defaultdict(dict)  # self.product_stores[product_id] = {store_id: None}, an ordered set
+        self.customer_stores = defaultdict(dict)  # self.customer_stores[cust_id] = {store_id: None}
+        self.lock = threading.Lock()  # stores are updated from several threads by an OrderEngine
+
+    def set_stock(self, store_id, product_id, quantity):
+        """ note the units store_id now has of product_id """
+        with self.lock:
+            self.stock.update((store_id, product_id), quantity)
+            self.product_stores[product_id][store_id] = None
+
+    def record_sale(self, store_id, product_id, cust_id, quantity):
+        """ note that store_id sold quantity of product_id to cust_id """
+        with self.lock:
+            self.units_sold[product_id] += quantity
+            self.sold.update(product_id, -self.units_sold[product_id])
+            self.customer_stores[cust_id][store_id] = None
+
+
+class IdInterner:
+    """ Hands out a small integer code for every distinct id string, so each id is stored once
+    and compact stores can keep integer codes in arrays instead of strings in dictionaries
+    """
+    def __init__(self):
+        self.codes = dict()  # self.codes[id] = code
+        self.ids = []  # self.ids[code] = id
+        self.lock = threading.Lock()  # only taken when a new id is added
+
+    def code(self, id_):
+        """ return the code of id_, assigning the next free code the first time id_ is seen """
+        code = self.codes.get(id_)
+        if code is None:
+            with self.lock: # two threads must not hand out different codes for the same new id
+                code = self.codes.get(id_)
+                if code is None:
+                    code = len(self.ids)
+                    self.ids.append(id_)
+                    self.codes[id_] = code
+        return code
+
+    def intern(self, id_):
+        """ return the one shared copy of the id string """
+        return self.ids[self.code(id_)]
+
+    def __getitem__(self, code):
+        return self.ids[code]
+
+
+class _StockView(Mapping):
+    """ Read-only dict view over a CompactStore's stock array, so store.products keeps working.
+    Like the defaultdict it replaces, reading a product the store doesn't carry with [] adds it with 0 units,
+    while in and get() only look
+    """
+    def __init__(self, store):
+        self._store = store
+
+    def __getitem__(self, product_id):
+        return self._store._stock[self._store._slot(product_id)]
+
+    def __contains__(self, product_id):
+        return self._store._find_slot(product_id) is not None
+
+    def get(self, product_id, default=None):
+        slot = self._store._find_slot(product_id)
+        return default if slot is None else self._store._stock[slot]
+
+    def __iter__(self):
+        ids = self._store.interner.ids
+        return (ids[code] for code in self._store._product_codes)
+
+    def __len__(self):
+        return len(self._store._product_codes)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class CompactStore(Store):
+    """ Same interface as Store, but ids are interned to integer codes and quantities live in
+    contiguous typed arrays instead of a defaultdict per product.
+    Sales are appended to a small log and merged into sorted (product, customer) arrays from time to time
+    """
+    MIN_LOG = 1 << 16  # sales kept in the log before they are merged into the sorted arrays
+    __slots__ = ('interner', '_slots', '_product_codes', '_stock', '_sold', '_sold_order', '_sale_keys', '_sale_qty', '_log_keys', '_log_qty')
+
+    def __init__(self, store_id, name, interner):
+        self.store_id = store_id
+        self.name = name
+        self.interner = interner
+
+        self._slots = dict()  # self._slots[product_code] = position of the product in the arrays below
+        self._product_codes = array('l')  # self._product_codes[slot] = product_code
+        self._stock = array('q')  # self._stock[slot] = inventory_qty
+        self._sold = bytearray()  # self._sold[slot] = 1 once the product has been sold
+        self._sold_order = array('l')  # slots in the order of their first sale, to match Store.pt_row
+        self._sale_keys = array('q')  # sorted (slot << 32) | cust_code, one per (product, customer) pair
+        self._sale_qty = array('q')  # self._sale_qty[i] = quantity sold for self._sale_keys[i]
+        self._log_keys = array('q')  # sales not merged yet, in arrival order
+        self._log_qty = array('q')
+        self.index = None  # SalesIndex told about every stock change and sale, once Ecommerce.build_index has been called
+
+    @property
+    def products(self):
+        """ self.products[product_id] = inventory_qty, as a dict-like view """
+        return _StockView(self)
+
+    def _slot(self, product_id):
+        """ return the array position of product_id, adding the product with 0 units if it is new """
+        code = self.interner.code(product_id)
+        slot = self._slots.get(code)
+        if slot is None:
+            slot = self._slots[code] = len(self._product_codes)
+            self._product_codes.append(code)
+            self._stock.append(0)
+            self._sold.append(0)
+        return slot
+
+    def _find_slot(self, product_id):
+        """ return the array position of product_id, or None if the store doesn't carry it """
+        return self._slots.get(self.interner.codes.get(product_id))
+
+    def add_product(self, product_id, quantity=0):
+        """adds products from inventory"""
+        slot = self._slot(product_id)
+        self._stock[slot] += int(quantity)
+        if self.index is not None:
+            self.index.set_stock(self.store_id, product_id, self._stock[slot])
+
+    def sell_product(self, product_id, quantity, cust_id):
+        """ tell the store that a Customer bought a product """
+        slot = self._slot(product_id)
+        self._stock[slot] -= int(quantity)
+        if not self._sold[slot]:
+            self._sold[slot] = 1
+            self._sold_order.append(slot)
+        self._log_keys.append((slot << 32) | self.interner.code(cust_id))
+        self._log_qty.append(int(quantity))
+        if len(self._log_keys) >= max(self.MIN_LOG, len(self._sale_keys)): # grows with the store, so merging stays amortized O(log n) per sale
+            self._merge_log()
+        if self.index is not None:
+            self.index.set_stock(self.store_id, product_id, self._stock[slot])
+            self.index.record_sale(self.store_id, product_id, cust_id, int(quantity))
+
+    def add_sales(self, product_id, sales, units=None):
+        """ tell the store that customers bought {cust_id: quantity} of a product, in order of purchase """
+        for cust_id, quantity in sales.items():
+            self.sell_product(product_id, quantity, cust_id)
+
+    def restore(self, stock, sales):
+        """ set the state of a store that has no stock or sales yet, as saved by a snapshot:
+        stock = {product_id: inventory_qty} and sales = {product_id: {cust_id: quantity}}, in order of the first sale """
+        code = self.interner.code
+        self._product_codes = array('l', map(code, stock))
+        self._slots = dict(zip(self._product_codes, range(len(self._product_codes))))
+        self._stock = array('q', stock.values())
+        self._sold = bytearray(len(self._product_codes))
+        self._sold_order = array('l', map(self._slots.__getitem__, map(code, sales)))
+        deque(map(self._sold.__setitem__, self._sold_order, repeat(1)), maxlen=0)
+        keys, quantities = [], []
+        for slot, sales_info in zip(self._sold_order, sales.values()):
+            keys.extend(map(or_, repeat(slot << 32), map(code, sales_info)))
+            quantities.extend(sales_info.values())
+        order = sorted(range(len(keys)), key=keys.__getitem__)
+        self._sale_keys = array('q', map(keys.__getitem__, order))
+        self._sale_qty = array('q', map(quantities.__getitem__, order))
+
+    def _merge_log(self):
+        """ fold the sales log into the sorted pair arrays """
+        if not self._log_keys:
+            return
+        pending = defaultdict(int)
+        for key, quantity in zip(self._log_keys, self._log_qty):
+            pending[key] += quantity
+        keys, qty = array('q'), array('q')
+        new_keys = sorted(pending)
+        i = j = 0
+        old_keys, old_qty = self._sale_keys, self._sale_qty
+        while i < len(old_keys) or j < len(new_keys):
+            if j == len(new_keys) or (i < len(old_keys) and old_keys[i] < new_keys[j]):
+                keys.append(old_keys[i])
+                qty.append(old_qty[i])
+                i += 1
+            else:
+                key = new_keys[j]
+                quantity = pending[key]
+                if i < len(old_keys) and old_keys[i] == key:
+                    quantity += old_qty[i]
+                    i += 1
+                keys.append(key)
+                qty.append(quantity)
+                j += 1
+        self._sale_keys, self._sale_qty = keys, qty
+        self._log_keys, self._log_qty = array('q'), array('q')
+
+    def sales_items(self):
+        """ yield (product_id, cust_id, quantity) for every product sold to a customer, products in order of the first sale """
+        self._merge_log()
+        ids = self.interner.ids
+        keys = self._sale_keys
+        for slot in self._sold_order:
+            product_id = ids[self._product_codes[slot]]
+            for index in range(bisect_left(keys, slot << 32), bisect_left(keys, (slot + 1) << 32)):
+                yield product_id, ids[keys[index] & 0xFFFFFFFF], self._sale_qty[index]
+
+    def pt_row(self):
+        """ this generator yields the rows that go into the Store PrettyTable, in the same order as Store.pt_row """
+        self._merge_log()
+        ids = self.interner.ids
+        keys = self._sale_keys
+        for slot in self._sold_order:
+            first = bisect_left(keys, slot << 32)
+            last = bisect_left(keys, (slot + 1) << 32)
+            cust_list = [ids[key & 0xFFFFFFFF] for key in keys[first:last]]
+            yield [self.name, ids[self._product_codes[slot]], sorted(cust_list), sum(self._sale_qty[first:last])]
+
+    def customer_count(self, product_id):
+        """ number of distinct customers who bought product_id """
+        slot = self._find_slot(product_id)
+        if slot is None:
+            return 0
+        self._merge_log()
+        return bisect_left(self._sale_keys, (slot + 1) << 32) - bisect_left(self._sale_keys, slot << 32)
+
+    def recompute_rows(self):
+        """ the same rows as pt_row, re-summed from sales_items. Kept to check the sorted pair arrays """
+        for product_id, sales in groupby(self.sales_items(), key=itemgetter(0)):
+            sales = list(sales)
+            yield [self.name, product_id, sorted(cust_id for _, cust_id, _ in sales), sum(quantity for _, _, quantity in sales)]
+
+
+def deep_sizeof(obj, seen=None):
+    """ approximate number of bytes used by obj and everything it references """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)  # for arrays this already includes the buffer
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(key, seen) + deep_sizeof(value, seen) for key, value in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_sizeof(item, seen) for item in obj)
+    if hasattr(obj, '__dict__'):
+        size += deep_sizeof(vars(obj), seen)
+    for cls in type(obj).__mro__:
+        for attr in getattr(cls, '__slots__', ()):
+            if hasattr(obj, attr):
+                size += deep_sizeof(getattr(obj, attr), seen)
+    return size
+
+
+def benchmark_memory(dir_path):
+    """ load dir_path with the dict stores and the compact stores and print the memory used by each """
+    with open(os.devnull, 'w') as devnull, redirect_stdout(devnull): # keep the per-transaction prints out of the report
+        usage = {'dict': Ecommerce(dir_path).memory_usage(), 'compact': Ecommerce(dir_path, compact=True).memory_usage()}
+    for backend, sizes in usage.items():
+        print("{:8} customers: {:>14,} bytes  stores: {:>14,} bytes".format(backend, sizes['customers'], sizes['stores']))
+    saved = usage['dict']['stores'] - usage['compact']['stores']
+    print("compact stores save {:,} bytes ({:.0%})".format(saved, saved / usage['dict']['stores'] if usage['dict']['stores'] else 0))
+    return usage
+
+
+def benchmark_processes(dir_path, process_counts=(1, 2, 4)):
+    """ load dir_path with the default sequential loop, with batch=True and with each number of processes, check the
+        results match and print the speedup over the sequential load, the time to beat. Shards are settled in
+        parallel, so the speedup can only show with at least as many cores as processes """
+    quiet = TransactionLog('off')
+    print("{} cores".format(os.cpu_count()))
+    start = time.perf_counter()
+    serial = Ecommerce(dir_path, transaction_log=quiet)
+    baseline = time.perf_counter() - start
+    print("sequential: {:.3f}s, the time to beat".format(baseline))
+    timings = {'sequential': baseline}
+    for processes in ('batch',) + tuple(process_counts):
+        if processes != 'batch' and processes < 2:
+            continue
+        start = time.perf_counter()
+        if processes == 'batch':
+            loaded = Ecommerce(dir_path, transaction_log=quiet, batch=True)
+        else:
+            loaded = Ecommerce(dir_path, transaction_log=quiet, processes=processes)
+        timings[processes] = time.perf_counter() - start
+        same = all(loaded.customers[cust_id].products == customer.products for cust_id, customer in serial.customers.items()) \
+            and all(list(loaded.stores[store_id].pt_row()) == list(store.pt_row()) for store_id, store in serial.stores.items())
+        label = processes if processes == 'batch' else "{} processes".format(processes)
+        print("{}: {:.3f}s ({:.2f}x), same results: {}".format(label, timings[processes], baseline / timings[processes], same))
+    return timings
+
+
+def benchmark_customer_memory(count=100000, buyers=0.25, purchases=3):
+    """ print the bytes per customer of the __slots__ Customer against the original layout (a per-instance __dict__
+    and an eager defaultdict), for count customers of whom the buyers fraction bought purchases products each.
+    Ids are built fresh for every row, like the strings file_reader produces.
+    """
+    class DictCustomer:
+        """ the original Customer layout """
+        def __init__(self, cust_id, name):
+            self.cust_id = cust_id
+            self.name = name
+            self.products = defaultdict(int)
+
+        def buy_product(self, product_id, quantity):
+            self.products[product_id] += int(quantity)
+
+    results = dict()
+    for label, cls in (('before', DictCustomer), ('after', Customer)):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            customers = [cls('c{:08d}'.format(number), 'Customer') for number in range(count)]
+            for number in range(int(count * buyers)):
+                for product in range(purchases):
+                    customers[number].buy_product('p{:06d}'.format(product), '1')
+            results[label] = (tracemalloc.get_traced_memory()[0] - before) / count
+        finally:
+            tracemalloc.stop()
+        del customers
+        print("{:6}: {:.0f} bytes per customer".format(label, results[label]))
+    return results
+
+
+def benchmark_sqlite(dir_path):
+    """ load dir_path with the dict backend and with SQLite in a database file, write the store and customer reports
+        with each, and print the times and the peak Python memory (the SQLite page cache isn't Python memory) """
+    results = dict()
+    with tempfile.TemporaryDirectory() as db_dir, open(os.devnull, 'w') as devnull:
+        backends = {
+            'dict': lambda: Ecommerce(dir_path, transaction_log=TransactionLog('off')),
+            'sqlite': lambda: SqliteEcommerce(dir_path, os.path.join(db_dir, 'ecommerce.db'), transaction_log=TransactionLog('off')),
+        }
+        for backend, load in backends.items():
+            start = time.perf_counter()
+            ecommerce = load()
+            loaded = time.perf_counter()
+            rows = ecommerce.store_report(devnull, 'csv') + ecommerce.customer_report(devnull, 'csv')
+            reported = time.perf_counter()
+            ecommerce.close()
+            tracemalloc.start() # traced separately, so the tracing doesn't slow down the timed run
+            ecommerce = load()
+            ecommerce.store_report(devnull, 'csv')
+            ecommerce.customer_report(devnull, 'csv')
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            ecommerce.close()
+            results[backend] = {'load': loaded - start, 'reports': reported - loaded, 'rows': rows, 'peak_bytes': peak}
+            print("{:6} load: {:.3f}s  reports: {:.3f}s ({} rows)  peak memory: {:,} bytes".format(backend, loaded - start, reported - loaded, rows, peak))
+    return results
+
+
+def benchmark_store_rows(dir_path, repeat=5):
+    """ time building every store row from the running aggregates against re-summing Store.sales """
+    final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+    results = dict()
+    for method in ('pt_row', 'recompute_rows'):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            rows = sum(len(list(getattr(store, method)())) for store in final.stores.values())
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[method] = best
+        print("{}: {} rows in {:.4f}s".format(method, rows, best))
+    return results
+
+
+PRETTYTABLE_MAX_ROWS = 1000  # reports with more rows than this are streamed as fixed-width text in 'auto' format
+REPORT_FORMATS = ('auto', 'table', 'text', 'csv', 'jsonl')
+
+
+def write_report(header, rows, stream=None, fmt='auto', page=None, page_size=100, top=None, key=None, widths=None,
+                 max_table_rows=PRETTYTABLE_MAX_ROWS, chunk_rows=1000):
+    """ write the rows of a report to stream (sys.stdout by default) as they are produced, and return how many were written.
+    fmt is 'table' (PrettyTable), 'text' (fixed-width columns, widths from the header unless given), 'csv', 'jsonl'
+    or 'auto', which uses a PrettyTable up to max_table_rows rows and fixed-width text beyond that.
+    top=N keeps only the N rows with the largest key(row), page=n keeps only rows n*page_size up to (n+1)*page_size.
+    Apart from the PrettyTable, memory stays bounded by chunk_rows (or top) rows whatever the size of the report.
+    """
+    if fmt not in REPORT_FORMATS:
+        raise ValueError("Unknown report format", fmt, "expected one of", REPORT_FORMATS)
+    stream = sys.stdout if stream is None else stream
+    if top is not None:
+        rows = heapq.nlargest(top, rows, key=key)
+    if page is not None:
+        rows = islice(rows, page * page_size, (page + 1) * page_size)
+
+    if fmt in ('auto', 'table'):
+        rows = iter(rows)
+        first = list(islice(rows, max_table_rows + 1)) if fmt == 'auto' else list(rows)
+        if len(first) <= max_table_rows or fmt == 'table':
+            table = PrettyTable()
+            table.field_names = header
+            for row in first:
+                table.add_row(row)
+            stream.write(str(table) + '\n')
+            return len(first)
+        fmt, rows = 'text', chain(first, rows) # too big for a PrettyTable
+
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(stream)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow([' '.join(value) if isinstance(value, list) else value for value in row])
+            count += 1
+        return count
+
+    if fmt == 'text':
+        widths = widths or [max(len(name), 15) for name in header]
+        line = ' '.join('{:<%d}' % width for width in widths) + '\n'
+        buffer = [line.format(*header), line.format(*('-' * width for width in widths))]
+    else:
+        buffer = []
+    for row in rows:
+        buffer.append(line.format(*map(str, row)) if fmt == 'text' else json.dumps(dict(zip(header, row))) + '\n')
+        count += 1
+        if len(buffer) >= chunk_rows:
+            stream.write(''.join(buffer))
+            buffer = []
+    stream.write(''.join(buffer))
+    return count
+
+
+def generate_data(dir_path, transactions=1000, customers=None, stores=None, products=None, seed=0, chunk_lines=100000):
+    """ write a synthetic data set of the given number of transactions into dir_path, in the same formats as the
+    real files. The other sizes default to scaling with the transactions. The same seed always gives the same files,
+    and lines are written chunk_lines at a time so even 100M transactions don't have to fit in memory.
+    """
+    customers = customers or max(10, transactions // 20)
+    stores = stores or max(3, transactions // 10000)
+    products = products or max(stores, transactions // 50)
+    generator = random.Random(seed)
+
+    def write(file_name, header, lines):
+        with open(os.path.join(dir_path, file_name), 'w') as fp:
+            if header is not None:
+                fp.write(header + '\n')
+            chunk = []
+            for line in lines:
+                chunk.append(line)
+                if len(chunk) >= chunk_lines:
+                    fp.write('\n'.join(chunk) + '\n')
+                    chunk = []
+            if chunk:
+                fp.write('\n'.join(chunk) + '\n')
+
+    write('customers.txt', None, ('c{:07d},Customer {}'.format(number, number) for number in range(customers)))
+    write('stores.txt', 'store_id*name', ('s{:05d}*Store {}'.format(number, number) for number in range(stores)))
+    write('products.txt', None, ('p{:07d}|s{:05d}|Product {}'.format(number, number % stores, number) for number in range(products)))
+    write('inventory.txt', 'store_id|quantity|product_id',
+          ('s{:05d}|{}|p{:07d}'.format(number % stores, generator.randrange(0, 200), number) for number in range(products)))
+    choose = generator.randrange
+    write('transactions.txt', 'cust_id|quantity|product_id|store_id',
+          ('c{:07d}|{}|p{:07d}|s{:05d}'.format(choose(customers), choose(1, 11), product, product % stores)
+           for product in (choose(products) for _ in range(transactions))))
+
+
+BENCHMARK_STAGES = ('import_customers', 'import_stores', 'import_products', 'import_inventory', 'import_transactions',
+                    'settle_batch', 'customer_report', 'store_report', 'customer_csv', 'store_jsonl')
+
+
+def run_benchmarks(dir_path, baseline=None, save_baseline=None, tolerance=0.25, compact=False):
+    """ time every import stage, batch settlement and the reports on the data in dir_path, and measure the peak
+    memory each one allocates (in a second, tracemalloc-traced run so the timings aren't slowed down).
+    Stages more than tolerance slower or bigger than in the baseline JSON file are reported as regressions.
+    Returns {'stages': {stage: {'seconds': s, 'peak_bytes': b}}, 'regressions': [messages]}
+    """
+    def stages():
+        """ this generator yields (stage name, function) in order, each function working on the state the previous ones built """
+        ecommerce = Ecommerce.empty(dir_path, compact, TransactionLog('off'))
+        for name in BENCHMARK_STAGES[:5]:
+            yield name, lambda method=getattr(ecommerce, name): method(dir_path)
+        settled = Ecommerce.empty(dir_path, compact, TransactionLog('off'))
+        for name in BENCHMARK_STAGES[:4]: # untimed set up, so only the settlement is measured
+            getattr(settled, name)(dir_path)
+        yield 'settle_batch', lambda: settled.import_transactions(dir_path, batch=True)
+        with open(os.devnull, 'w') as devnull:
+            yield 'customer_report', lambda: ecommerce.customer_report(devnull, 'text')
+            yield 'store_report', lambda: ecommerce.store_report(devnull, 'text')
+            yield 'customer_csv', lambda: ecommerce.customer_report(devnull, 'csv')
+            yield 'store_jsonl', lambda: ecommerce.store_report(devnull, 'jsonl')
+
+    results = {name: dict() for name in BENCHMARK_STAGES}
+    for name, run in stages():
+        start = time.perf_counter()
+        run()
+        results[name]['seconds'] = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        for name, run in stages():
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            run()
+            results[name]['peak_bytes'] = tracemalloc.get_traced_memory()[1] - before
+    finally:
+        tracemalloc.stop()
+
+    regressions = []
+    if baseline is not None and os.path.exists(baseline):
+        with open(baseline) as fp:
+            saved = json.load(fp)
+        for name, measured in results.items():
+            for metric, value in measured.items():
+                reference = saved.get(name, dict()).get(metric)
+                if reference and value > reference * (1 + tolerance):
+                    regressions.append("{} {}: {:.4g} vs baseline {:.4g} (+{:.0%})".format(name, metric, value, reference, value / reference - 1))
+    if save_baseline is not None:
+        with open(save_baseline, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    for name, measured in results.items():
+        print("{:20} {:10.4f}s {:>16,} bytes peak".format(name, measured['seconds'], measured['peak_bytes']))
+    for regression in regressions:
+        print("REGRESSION:", regression)
+    return {'stages': results, 'regressions': regressions}
+
+
+def write_sample_data(dir_path):
+    """ write a small, hand-checked data set into dir_path. Used by the unit tests """
+    files = {
+        'customers.txt': ['c01,Debugging Dinesh', 'c02,Python Pam', 'c03,GitHub Gus'],
+        'stores.txt': ['store_id*name', "s00*Maha's Movies", "s01*Ben's Books", "s02*Dariel's Donuts"],
+        'products.txt': ['p00|s00|DVD', 'p01|s00|Bluray', 'p02|s01|Novel', 'p03|s01|Comic', 'p04|s01|Atlas', 'p05|s02|Glazed', 'p06|s02|Cruller'],
+        'inventory.txt': ['store_id|quantity|product_id', 's00|91|p00', 's00|27|p01', 's01|2|p02', 's01|1|p03', 's01|31|p04', 's02|72|p05', 's02|100|p06'],
+        'transactions.txt': ['cust_id|quantity|product_id|store_id', 'c01|4|p00|s00', 'c01|6|p01|s00', 'c02|4|p01|s00', 'c01|1|p02|s01',
+                             'c02|3|p02|s01', 'c01|5|p03|s01', 'c02|2|p03|s01', 'c03|1|p04|s01', 'c01|11|p05|s02', 'c02|8|p05|s02',
+                             'c03|6|p05|s02', 'c02|16|p06|s02', 'c03|20|p06|s02', 'c03|999|p06|s02'],
+    }
+    for file_name, lines in files.items():
+        with open(os.path.join(dir_path, file_name), 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+
 def main():
+    # loading leaves the data files closed; after final.ingest() or final.tail(), final.close() releases them
     final = Ecommerce('G:\My Drive\F18\SSW-810\FINAL')
     print("Store Summary")
-    print(final.store_pt())
+    final.store_report()
     print("Customer Summary")
-    print(final.customer_pt())
+    final.customer_report()
     
 
 class EcommerceTest(unittest.TestCase):
@@ -205,6 +2578,610 @@ class EcommerceTest(unittest.TestCase):
         self.assertEqual(final.stores['s02'].name, "Dariel's Donuts")
         # self.assertEqual(final.stores['s02'].products, {'p05': 72, 'p06': 100}) # tested inventory before transactions
         self.assertEqual(final.stores['s02'].products, {'p05': 72-25, 'p06': 100-36}) # tests after transaction. Sold 25 of p05 and 36 of p06
+
+    def test_file_batches(self):
+        """Tests that file_batches yields the same rows as file_reader, across block boundaries, and reports the same bad line"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            transactions_file = os.path.join(dir_path, "transactions.txt")
+            rows = list(file_reader(transactions_file, 4, '|', True))
+            for chunk_size in (1, 7, 1 << 20):
+                batches = file_batches(transactions_file, 4, '|', True, chunk_size=chunk_size)
+                self.assertEqual([row for batch in batches for row in batch], rows)
+
+            with open(transactions_file, 'a') as fp:
+                fp.write("c01|1|p00\n")
+            with self.assertRaises(ValueError) as expected:
+                list(file_reader(transactions_file, 4, '|', True))
+            batch_rows = []
+            with self.assertRaises(ValueError) as actual:
+                for batch in file_batches(transactions_file, 4, '|', True, chunk_size=16):
+                    batch_rows.extend(batch)
+            self.assertEqual(actual.exception.args, expected.exception.args)
+            self.assertEqual(batch_rows, rows)
+
+    def test_mmap_batches(self):
+        """Tests that mmap_batches gives file_reader's rows with int quantities and shared ids, and the same bad line"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            transactions_file = os.path.join(dir_path, "transactions.txt")
+            rows = [(cust_id, int(quantity), product_id, store_id) for cust_id, quantity, product_id, store_id in file_reader(transactions_file, 4, '|', True)]
+            for chunk_size in (1, 7, 1 << 20):
+                batches = mmap_batches(transactions_file, 4, '|', True, int_fields=(1,), chunk_size=chunk_size)
+                mapped = [row for batch in batches for row in batch]
+                self.assertEqual(mapped, rows)
+            self.assertIs(mapped[0][3], mapped[1][3]) # both lines are for s00
+
+            with open(transactions_file, 'a') as fp:
+                fp.write("c01|1|p00\r\n")
+            with self.assertRaises(ValueError) as expected:
+                list(file_reader(transactions_file, 4, '|', True))
+            mapped = []
+            with self.assertRaises(ValueError) as actual:
+                for batch in mmap_batches(transactions_file, 4, '|', True, int_fields=(1,), chunk_size=16):
+                    mapped.extend(batch)
+            self.assertEqual(actual.exception.args, expected.exception.args)
+            self.assertEqual(mapped, rows)
+            self.assertEqual(list(mmap_batches(os.path.join(dir_path, "missing.txt"), 4)), [])
+
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            with tempfile.TemporaryDirectory() as crlf_path: # files saved on Windows load the same
+                for file_name in SOURCE_FILES:
+                    with open(os.path.join(dir_path, file_name), 'rb') as fp, open(os.path.join(crlf_path, file_name), 'wb') as crlf:
+                        crlf.write(fp.read().replace(b'\r\n', b'\n').replace(b'\n', b'\r\n'))
+                for chunk_size in (1, 7, 1 << 20):
+                    self.assertEqual([row for batch in mmap_batches(os.path.join(crlf_path, "inventory.txt"), 3, '|', True, int_fields=(1,), chunk_size=chunk_size) for row in batch],
+                                     [(store_id, int(quantity), product_id) for store_id, quantity, product_id in file_reader(os.path.join(dir_path, "inventory.txt"), 3, '|', True)])
+                with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                    loaded = [Ecommerce(crlf_path, transaction_log=TransactionLog('off')), SqliteEcommerce(crlf_path, transaction_log=TransactionLog('off'))]
+                for windows in loaded:
+                    self.assertEqual({store_id: dict(store.products) for store_id, store in windows.stores.items()},
+                                     {store_id: dict(store.products) for store_id, store in final.stores.items()})
+                    self.assertEqual(list(windows.customer_rows()), list(final.customer_rows()))
+                    self.assertEqual(list(windows.store_rows()), list(final.store_rows()))
+                    windows.close()
+
+            with open(transactions_file, 'w') as fp: # a quantity that isn't a number, in the middle of a block
+                fp.write("cust_id|quantity|product_id|store_id\nc01|4|p00|s00\nc01|6|p01|s00\nc02|x|p01|s00\nc01|1|p02|s01\n")
+            mapped = []
+            with self.assertRaises(ValueError) as bad:
+                for batch in mmap_batches(transactions_file, 4, '|', True, int_fields=(1,)):
+                    mapped.extend(batch)
+            self.assertEqual(mapped, rows[:2])
+            self.assertEqual(bad.exception.args, (transactions_file, "has", "x", "in field", 2, "of", 4, "but expected an integer"))
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                for processes in (None, 2): # the two rows before the bad line are still settled, like file_reader did
+                    final = Ecommerce(dir_path, transaction_log=TransactionLog('off'), processes=processes)
+                    self.assertEqual(final.stores['s00'].units_sold, {'p00': 4, 'p01': 6})
+
+    def test_settle_transactions(self):
+        """Tests that settling rows already in memory gives the same customers, stock and sales as importing the file"""
+        with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path)
+            rows = list(file_reader(os.path.join(dir_path, "transactions.txt"), 4, '|', True))
+            settled = Ecommerce(dir_path, transactions=False)
+            settled.settle_transactions(rows)
+            compact = Ecommerce(dir_path, compact=True, transactions=False)
+            compact.settle_transactions(rows)
+        for settled in (settled, compact):
+            for cust_id, customer in final.customers.items():
+                self.assertEqual(list(settled.customers[cust_id].pt_row()), list(customer.pt_row()))
+            for store_id, store in final.stores.items():
+                self.assertEqual(settled.stores[store_id].products, store.products)
+                self.assertEqual(list(settled.stores[store_id].pt_row()), list(store.pt_row()))
+        self.assertEqual(settled.customers['c03'].products['p06'], 20 + (100 - 16 - 20)) # the last request only gets what is left
+
+    def test_batch_settlement(self):
+        """Tests that batch settlement gives the same customers, stock, sales and purchase events as the sequential loop"""
+        def state(ecommerce):
+            return ([(cust_id, list(customer.purchase_items())) for cust_id, customer in ecommerce.customers.items()],
+                    [(store_id, dict(store.products), list(store.products), list(store.sales_items()), list(store.pt_row()))
+                     for store_id, store in ecommerce.stores.items()])
+
+        with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            write_sample_data(dir_path)
+            for compact in (False, True):
+                logs = [TransactionLog('jsonl', io.StringIO()) for _ in range(2)]
+                final = Ecommerce(dir_path, compact=compact, transaction_log=logs[0])
+                batch = Ecommerce(dir_path, compact=compact, transaction_log=logs[1], batch=True)
+                self.assertEqual(state(batch), state(final))
+                self.assertEqual(logs[1].stream.getvalue(), logs[0].stream.getvalue())
+            self.assertEqual(batch.customers['c03'].products['p06'], 20 + (100 - 16 - 20)) # the last request only gets what is left
+
+            rows = [('c01', '5', 'p00', 's00'), ('c02', '-3', 'p00', 's00'), ('c01', '2', 'p99', 's00'), ('c02', '9', 'p01', 's00'), ('c01', '0', 'p01', 's00')]
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            final.settle_transactions(rows)
+            batch = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            batch.settle_batch(rows) # a negative request and a product the store doesn't carry take the sequential steps
+            self.assertEqual(state(batch), state(final))
+
+            generate_data(dir_path, 5000, customers=40, products=30)
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            batch = Ecommerce(dir_path, transaction_log=TransactionLog('off'), batch=True)
+            self.assertEqual(state(batch), state(final)) # most products run out part way through
+            self.assertTrue(any(0 in store.products.values() for store in final.stores.values()))
+
+    def test_sharded_import(self):
+        """Tests that settling the store shards on a process pool matches the sequential loop"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            serial_log, sharded_log = io.StringIO(), io.StringIO()
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('text', serial_log))
+            sharded = Ecommerce(dir_path, transaction_log=TransactionLog('text', sharded_log), processes=2)
+        self.assertEqual(sharded_log.getvalue(), serial_log.getvalue())
+        for cust_id, customer in final.customers.items():
+            self.assertEqual(list(sharded.customers[cust_id].pt_row()), list(customer.pt_row()))
+        for store_id, store in final.stores.items():
+            self.assertEqual(sharded.stores[store_id].products, store.products)
+            self.assertEqual(list(sharded.stores[store_id].pt_row()), list(store.pt_row()))
+
+    def test_ingest(self):
+        """Tests that ingest applies only appended lines, and copes with partial lines, rotation and truncation"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            transactions_file = os.path.join(dir_path, "transactions.txt")
+            self.assertEqual([tail.fp for tail in final.tails.values()], [None, None]) # loading doesn't hold the files open
+            self.assertEqual(final.ingest(), {'inventory.txt': 0, 'transactions.txt': 0})
+
+            with open(os.path.join(dir_path, "inventory.txt"), 'a') as fp:
+                fp.write("s00|5|p00\n")
+            with open(transactions_file, 'a') as fp:
+                fp.write("c02|3|p00|s00\nc03|2|p0")
+            self.assertEqual(final.ingest(), {'inventory.txt': 1, 'transactions.txt': 1})
+            self.assertEqual(final.customers['c02'].products['p00'], 3)
+            self.assertEqual(final.stores['s00'].products['p00'], 91 - 4 + 5 - 3)
+
+            with open(transactions_file, 'a') as fp:
+                fp.write("0|s00\n")
+            os.rename(transactions_file, transactions_file + ".1") # rotate after a last write the tail hasn't seen
+            with open(transactions_file, 'w') as fp:
+                fp.write("cust_id|quantity|product_id|store_id\nc01|1|p01|s00\n")
+            self.assertEqual(final.ingest()['transactions.txt'], 2)
+            self.assertEqual(final.customers['c03'].products['p00'], 2)
+            self.assertEqual(final.customers['c01'].products['p01'], 6 + 1)
+
+            with open(transactions_file, 'w') as fp: # truncate and start over
+                fp.write("cust_id|quantity|product_id|store_id\n")
+            self.assertEqual(final.ingest()['transactions.txt'], 0)
+            with open(transactions_file, 'a') as fp:
+                fp.write("c01|2|p01|s00\n")
+            self.assertEqual(final.ingest()['transactions.txt'], 1)
+            self.assertEqual(final.customers['c01'].products['p01'], 6 + 1 + 2)
+            final.close()
+
+            with open(transactions_file, 'a') as fp: # the first read of a new instance continues where loading stopped
+                fp.write("c02|1|p00|s00\n")
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            with open(transactions_file, 'a') as fp:
+                fp.write("c02|1|p00|s00\n")
+            self.assertEqual(final.ingest()['transactions.txt'], 1)
+            self.assertEqual(final.customers['c02'].products['p00'], 1 + 1)
+            final.close()
+
+            with open(transactions_file, 'a') as fp: # a line still being written while loading is left to ingest
+                fp.write("c03|1|p0")
+            complete = os.path.getsize(transactions_file) - len("c03|1|p0")
+            for backend in (Ecommerce, SqliteEcommerce):
+                final = backend(dir_path, transaction_log=TransactionLog('off'))
+                tail = final.tails['transactions.txt']
+                self.assertEqual((tail.offset, tail.line_number), (complete, 4))
+                self.assertNotIn('p0', final.customers['c03'].products)
+                with open(transactions_file, 'a') as fp:
+                    fp.write("0|s00\n")
+                self.assertEqual(final.ingest()['transactions.txt'], 1)
+                self.assertEqual(final.customers['c03'].products['p00'], 1)
+                final.close()
+                with open(transactions_file, 'rb+') as fp: # unfinish the line again for the next backend
+                    fp.truncate(complete + len("c03|1|p0"))
+
+            with open(transactions_file, 'a') as fp:
+                fp.write("0|s00\n")
+            loaded = os.path.getsize(transactions_file)
+            for backend in (Ecommerce, SqliteEcommerce): # bad rows are reported and skipped, the rows after them still apply
+                final = backend(dir_path, transaction_log=TransactionLog('off'))
+                bought = final.customers['c02'].products['p00']
+                with open(transactions_file, 'a') as fp:
+                    fp.write("c01|x|p00|s00\nc01|1|p00|s99\nc99|1|p00|s00\nc02|1|p00|s00\n")
+                with redirect_stdout(io.StringIO()) as reported:
+                    self.assertEqual(final.ingest()['transactions.txt'], 1)
+                self.assertEqual(len(reported.getvalue().splitlines()), 3)
+                self.assertEqual(final.ingest()['transactions.txt'], 0)
+                self.assertEqual(final.customers['c02'].products['p00'], bought + 1)
+                final.close()
+                with open(transactions_file, 'rb+') as fp:
+                    fp.truncate(loaded)
+
+    def test_snapshot(self):
+        """Tests that a snapshot restores the same state, catches up on appended lines and is rebuilt when stale"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            snapshot = os.path.join(dir_path, "state.snap")
+            quiet = TransactionLog('off')
+            final = Ecommerce(dir_path, transaction_log=quiet, snapshot=snapshot)
+            self.assertTrue(snapshot_is_fresh(snapshot, dir_path))
+            with open(os.path.join(dir_path, "transactions.txt"), 'a') as fp:
+                fp.write("c02|1|p04|s01\n")
+            final.ingest()
+            for compact in (False, True):
+                restored = Ecommerce(dir_path, compact=compact, transaction_log=quiet, snapshot=snapshot)
+                self.assertEqual(restored.tails['transactions.txt'].offset, final.tails['transactions.txt'].offset)
+                for cust_id, customer in final.customers.items():
+                    self.assertEqual(restored.customers[cust_id].name, customer.name)
+                    self.assertEqual(list(restored.customers[cust_id].pt_row()), list(customer.pt_row()))
+                for store_id, store in final.stores.items():
+                    self.assertEqual(restored.stores[store_id].products, store.products)
+                    self.assertEqual(list(restored.stores[store_id].pt_row()), list(store.pt_row()))
+                restored.close()
+
+            with open(os.path.join(dir_path, "customers.txt"), 'a') as fp:
+                fp.write("c04,Pandas Pete\n")
+            self.assertFalse(snapshot_is_fresh(snapshot, dir_path))
+            rebuilt = Ecommerce(dir_path, transaction_log=quiet, snapshot=snapshot)
+            self.assertIn('c04', rebuilt.customers)
+            self.assertTrue(snapshot_is_fresh(snapshot, dir_path))
+            rebuilt.close()
+
+            for header in ({'byteorder': sys.byteorder}, {'byteorder': sys.byteorder, 'sources': [], 'tails': {}}, []):
+                encoded = json.dumps(header).encode()
+                with open(snapshot, 'wb') as fp: # a header without sources or tails, e.g. from an older writer
+                    fp.write(SNAPSHOT_MAGIC + len(encoded).to_bytes(8, 'little') + encoded)
+                self.assertFalse(snapshot_is_fresh(snapshot, dir_path))
+                rebuilt = Ecommerce(dir_path, transaction_log=quiet, snapshot=snapshot)
+                self.assertIn('c04', rebuilt.customers)
+                self.assertTrue(snapshot_is_fresh(snapshot, dir_path))
+                rebuilt.close()
+            final.close()
+
+    def test_reports(self):
+        """Tests the streamed report formats, top-N, pagination and the PrettyTable fallback"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+        stream = io.StringIO()
+        self.assertEqual(final.store_report(stream), 7)
+        self.assertEqual(stream.getvalue(), str(final.store_pt()) + '\n')
+
+        stream = io.StringIO()
+        final.store_report(stream, 'csv', top=2)
+        self.assertEqual(stream.getvalue().splitlines(), ['Store,Products,Customers,Quantity Sold', "Dariel's Donuts,p06,c02 c03,100", "Dariel's Donuts,p05,c01 c02 c03,25"])
+
+        stream = io.StringIO()
+        self.assertEqual(final.customer_report(stream, 'jsonl', page=1, page_size=4), 4)
+        rows = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(rows[0], {'Customer Name': 'Debugging Dinesh', 'Product': 'p05', 'Quantity Purchased': 11})
+
+        stream = io.StringIO()
+        self.assertEqual(final.customer_report(stream, max_table_rows=3), 13)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 2 + 13)
+        self.assertEqual(lines[2].split(), ['Debugging', 'Dinesh', 'p00', '4'])
+
+    def test_transaction_log(self):
+        """Tests the buffered text and JSON lines transaction logs, sampling and the per store summary"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            text = io.StringIO()
+            with redirect_stdout(text):
+                Ecommerce(dir_path)
+            lines = text.getvalue().splitlines()
+            self.assertEqual(len(lines), 14)
+            self.assertEqual(lines[-1], "Customer c03 wants 999 of p06. Store s02 has 64 in stock. Customer will recieve 64")
+
+            for processes in (None, 2):
+                stream = io.StringIO()
+                final = Ecommerce(dir_path, transaction_log=TransactionLog('jsonl', stream, buffer_size=4), processes=processes)
+                events = [json.loads(line) for line in stream.getvalue().splitlines()]
+                self.assertEqual(len(events), 14)
+                self.assertEqual(events[-1], {'cust_id': 'c03', 'product_id': 'p06', 'store_id': 's02', 'requested': 999, 'in_stock': 64, 'received': 64})
+                self.assertEqual(final.transaction_log.summary()['s02'], {'requested': 1060, 'fulfilled': 25 + 100, 'short': 1060 - 125})
+
+            stream = io.StringIO()
+            Ecommerce(dir_path, transaction_log=TransactionLog('text', stream, sample_every=5))
+            self.assertEqual(len(stream.getvalue().splitlines()), 2)
+
+            quiet = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            self.assertEqual(quiet.transaction_log.summary(), {})
+            self.assertEqual(quiet.customers['c03'].products['p06'], 84)
+
+    def test_store_aggregates(self):
+        """Tests that the running aggregates give the same rows as re-summing the sales"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+        for store in final.stores.values():
+            self.assertEqual(list(store.pt_row()), list(store.recompute_rows()))
+        self.assertEqual(final.stores['s02'].units_sold['p06'], 100)
+        self.assertEqual(final.stores['s02'].customer_count('p05'), 3)
+        self.assertEqual(final.stores['s00'].customer_count('p99'), 0)
+
+    def test_queries(self):
+        """Tests the indexed queries against the state of the stores, including updates after the index was built"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            for compact in (False, True):
+                final = Ecommerce(dir_path, compact=compact, transaction_log=TransactionLog('off'))
+                self.assertEqual(final.low_stock(1), [('s01', 'p02', 0), ('s01', 'p03', 0), ('s02', 'p06', 0)])
+                self.assertEqual(final.top_products(2), [('p06', 100), ('p05', 25)])
+                self.assertEqual(final.stores_for_customer('c03'), ['s01', 's02'])
+                self.assertEqual(final.stores_for_product('p04'), ['s01'])
+
+                final.stores['s01'].add_product('p02', 5)
+                final.stores['s00'].add_product('p05', 3)
+                final.stores['s00'].sell_product('p05', 2, 'c03')
+                self.assertEqual(final.low_stock(2), [('s01', 'p03', 0), ('s02', 'p06', 0), ('s00', 'p05', 1)])
+                self.assertEqual(final.top_products(2), [('p06', 100), ('p05', 27)])
+                self.assertEqual(final.stores_for_customer('c03'), ['s01', 's02', 's00'])
+                self.assertEqual(final.stores_for_product('p05'), ['s02', 's00'])
+                for _ in range(100): # enough updates to rebuild the heaps
+                    final.stores['s00'].add_product('p00', 1)
+                self.assertEqual(final.index.stock.smallest(1), [(0, ('s01', 'p03'))])
+                self.assertEqual(final.stores['s00'].products['p00'], 91 - 4 + 100)
+
+    def test_order_engine(self):
+        """Tests that orders from many threads never oversell: every SKU ends with what it had minus min(requested, in stock)"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            quiet = TransactionLog('off')
+            requests = list(file_reader(os.path.join(dir_path, "transactions.txt"), 4, '|', True)) * 20 + [('c01', '1', 'p00', 's00')]
+            requested = defaultdict(int)
+            for cust_id, quantity, product_id, store_id in requests:
+                requested[store_id, product_id] += int(quantity)
+            for compact in (False, True):
+                live = Ecommerce(dir_path, compact=compact, transaction_log=quiet, transactions=False)
+                initial = {(store_id, product_id): quantity for store_id, store in live.stores.items() for product_id, quantity in store.products.items()}
+                live.build_index()
+                engine = OrderEngine(live, workers=8)
+                received = [future.result() for future in [engine.submit(*request) for request in requests[:-1]]]
+                received.append(asyncio.run(engine.purchase_async(*requests[-1])))
+                engine.close()
+                for (store_id, product_id), quantity in initial.items():
+                    self.assertEqual(live.stores[store_id].products[product_id], quantity - min(requested[store_id, product_id], quantity))
+                self.assertEqual(sum(received), sum(min(requested[key], quantity) for key, quantity in initial.items()))
+                self.assertEqual(sum(sum(customer.products.values()) for customer in live.customers.values()), sum(received))
+                self.assertEqual(live.stores['s00'].products['p00'], 91 - 81)
+                self.assertEqual(live.low_stock(1)[0][2], 0)
+
+    def test_generate_data_and_benchmarks(self):
+        """Tests that the generated data loads, is reproducible, and that the benchmark suite flags regressions"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            generate_data(dir_path, transactions=500, seed=3, chunk_lines=64)
+            with open(os.path.join(dir_path, "transactions.txt")) as fp:
+                first = fp.read()
+            generate_data(dir_path, transactions=500, seed=3)
+            with open(os.path.join(dir_path, "transactions.txt")) as fp:
+                self.assertEqual(fp.read(), first)
+
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            self.assertEqual(len(final.customers), 25)
+            self.assertEqual(len(final.stores), 3)
+            self.assertEqual(sum(len(store.products) for store in final.stores.values()), 10)
+            self.assertEqual(sum(sum(customer.products.values()) for customer in final.customers.values()),
+                             sum(sum(store.units_sold.values()) for store in final.stores.values()))
+
+            baseline = os.path.join(dir_path, "baseline.json")
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                report = run_benchmarks(dir_path, save_baseline=baseline)
+            self.assertEqual(set(report['stages']), set(BENCHMARK_STAGES))
+            with open(baseline) as fp:
+                saved = json.load(fp)
+            saved['import_transactions']['seconds'] /= 100 # pretend it used to be much faster
+            with open(baseline, 'w') as fp:
+                json.dump(saved, fp)
+            with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                report = run_benchmarks(dir_path, baseline=baseline)
+            self.assertTrue(any(regression.startswith('import_transactions seconds') for regression in report['regressions']))
+
+    def test_metrics(self):
+        """Tests that the stages are measured when metrics are on, and the sampling profile finds the hot stage"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            metrics = Metrics()
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'), metrics=metrics)
+            final.store_report(io.StringIO(), 'csv')
+            report = metrics.report()['stages']
+            self.assertEqual(list(report), ['import_customers', 'import_stores', 'import_products', 'import_inventory', 'import_transactions', 'store_report'])
+            self.assertEqual(report['import_transactions']['rows'], 14)
+            self.assertEqual(report['store_report']['rows'], 7)
+            self.assertEqual(report['import_customers']['bytes'], os.path.getsize(os.path.join(dir_path, "customers.txt")))
+            exported = io.StringIO()
+            metrics.export(exported)
+            self.assertEqual(json.loads(exported.getvalue())['stages']['import_stores']['rows'], 3)
+            self.assertIsNone(Ecommerce(dir_path, transaction_log=TransactionLog('off')).metrics)
+
+        profiled = Metrics(profile=True, interval=0.0005)
+        profiled.measure('busy', lambda: sum(number * number for number in range(300000)))
+        self.assertTrue(profiled.hot_spots(1) and profiled.hot_spots(1)[0][0][0] == 'busy')
+
+    def test_sales_windows(self):
+        """Tests the window totals fed by import_transactions, and the HyperLogLog, Count-Min and Space-Saving sketches"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            for processes in (None, 2):
+                windows = SalesWindows(bucket_size=5, buckets=2, clock=None)
+                final = Ecommerce(dir_path, transaction_log=TransactionLog('off'), analytics=windows, processes=processes)
+                self.assertEqual(windows.tumbling('store'), [(5, {'s01': (3, 4), 's02': (11, 1)}), (10, {'s02': (114, 5)})]) # bucket 0 was dropped
+                self.assertEqual(windows.totals('customer', seconds=4), {'c02': (24, 2), 'c03': (90, 3)})
+                self.assertEqual(windows.top('product', 1), [('p06', 100, 3)])
+                self.assertEqual(windows.distinct_customers('s02', seconds=4), 2)
+                self.assertEqual(windows.distinct_customers('s00'), 0) # s00 only sold in the dropped bucket
+
+        windows = SalesWindows(bucket_size=60, buckets=3, capacity=10, count_min=(64, 3), clock=lambda: now)
+        for now in range(0, 180):
+            windows.record('c{}'.format(now), 'p{}'.format(now % 25), 's0', 1)
+            windows.record('c0', 'hot', 's0', 5)
+        self.assertEqual(windows.top('product', 1, seconds=59)[0][:2], ('hot', 300)) # only the last bucket, 120 to 179
+        self.assertGreaterEqual(windows.product_units('p3', seconds=59), 3)
+        self.assertEqual(windows.totals('store', seconds=59), {'s0': (360, 120)})
+        self.assertLessEqual(len(windows.totals('customer')), 10)
+        self.assertAlmostEqual(windows.distinct_customers(), 180, delta=18)
+        sketch = HyperLogLog(12)
+        for number in range(20000):
+            sketch.add(number)
+        self.assertAlmostEqual(sketch.estimate(), 20000, delta=1000)
+
+    def test_sqlite_backend(self):
+        """Tests that the SQLite backend gives the dict backend's reports and queries, persists, and ingests new lines"""
+        def reports(ecommerce):
+            customers, stores = io.StringIO(), io.StringIO()
+            ecommerce.customer_report(customers, 'csv')
+            ecommerce.store_report(stores, 'csv')
+            return customers.getvalue(), stores.getvalue()
+
+        with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            write_sample_data(dir_path)
+            database = os.path.join(dir_path, 'ecommerce.db')
+            final = Ecommerce(dir_path)
+            backend = SqliteEcommerce(dir_path, database)
+            self.assertEqual(reports(backend), reports(final))
+            self.assertEqual(backend.transaction_log.summary(), final.transaction_log.summary())
+            self.assertEqual(list(backend.stores), list(final.stores))
+            self.assertEqual(dict(backend.stores['s02'].products), dict(final.stores['s02'].products))
+            self.assertEqual(backend.customers['c03'].products, final.customers['c03'].products)
+            self.assertNotIn('c99', backend.customers)
+            for query, args in (('low_stock', (5,)), ('top_products', (3,)), ('stores_for_customer', ('c03',)), ('stores_for_product', ('p05',))):
+                self.assertEqual(getattr(backend, query)(*args), getattr(final, query)(*args))
+            for statement, index in (("SELECT store_id FROM sales WHERE cust_id = 'c03'", 'sales_by_customer'),
+                                     ("SELECT store_id FROM stock WHERE product_id = 'p05'", 'stock_by_product'),
+                                     ("SELECT store_id FROM stock WHERE quantity < 5", 'stock_by_quantity')):
+                plan = ' '.join(row[-1] for row in backend.db.execute("EXPLAIN QUERY PLAN " + statement))
+                self.assertIn(index, plan) # the queries look their rows up instead of scanning the table
+            backend.close()
+
+            with open(os.path.join(dir_path, "transactions.txt"), 'a') as fp:
+                fp.write("c02|3|p00|s00\n")
+            final.ingest()
+            reopened = SqliteEcommerce(dir_path, database, load=False)
+            self.assertEqual(reopened.ingest(), {'inventory.txt': 0, 'transactions.txt': 1}) # appended while it was closed
+            self.assertEqual(reports(reopened), reports(final))
+            self.assertEqual(reopened.stores['s00'].products['p00'], 91 - 4 - 3)
+            reopened.close()
+
+            with open(os.path.join(dir_path, "transactions.txt"), 'a') as fp:
+                fp.write("c02|3|p00|s00\n")
+            crashed = SqliteEcommerce(dir_path, database, load=False)
+            def crash():
+                raise OSError("crashed before the tails were saved")
+            crashed._save_tails = crash
+            with self.assertRaises(OSError):
+                crashed.ingest()
+            crashed.close()
+            reopened = SqliteEcommerce(dir_path, database, load=False)
+            self.assertEqual(reopened.ingest(), {'inventory.txt': 0, 'transactions.txt': 1}) # the settlement was rolled back with the tails
+            self.assertEqual(reopened.stores['s00'].products['p00'], 91 - 4 - 3 - 3)
+            reopened.close()
+
+        with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            generate_data(dir_path, 20000) # plenty of equal priorities, which both backends break by id
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            backend = SqliteEcommerce(dir_path, os.path.join(dir_path, 'ecommerce.db'), transaction_log=TransactionLog('off'))
+            self.assertEqual(backend.top_products(8), final.top_products(8))
+            self.assertEqual(backend.low_stock(50), final.low_stock(50))
+            backend.close()
+
+    def test_slots_entities(self):
+        """Tests that customers and stores have no __dict__, allocate purchases lazily and share id strings"""
+        customer = Customer('c09', 'Lazy Larry')
+        self.assertFalse(hasattr(customer, '__dict__'))
+        self.assertIsNone(customer._products)
+        self.assertEqual(list(customer.pt_row()), [])
+        self.assertIsNone(customer._products)
+        customer.buy_product(''.join(['p', '01']), '2')
+        customer.buy_product('p01', 3)
+        self.assertEqual(customer.products, {'p01': 5})
+        self.assertIs(next(iter(customer.products)), sys.intern('p01'))
+        self.assertEqual(customer.products['p02'], 0) # still a defaultdict
+        store = Store('s09', 'Slotted Store')
+        self.assertFalse(hasattr(store, '__dict__'))
+        store.add_product('p01', 3)
+        store.sell_product('p01', 2, ''.join(['c', '09']))
+        self.assertEqual(list(store.pt_row()), [['Slotted Store', 'p01', ['c09'], 2]])
+        self.assertIs(store.customer_index['p01'][0], sys.intern('c09'))
+        store.sell_product('p01', 1, 'c01') # a new customer only marks the sorted list stale
+        self.assertIsNone(store.customer_index['p01'])
+        self.assertEqual(list(store.pt_row()), [['Slotted Store', 'p01', ['c01', 'c09'], 3]])
+
+    def test_lazy_loading(self):
+        """Tests that the lazy mode only builds what is asked for and gives the same results as loading everything"""
+        with tempfile.TemporaryDirectory() as dir_path:
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path, transaction_log=TransactionLog('off'))
+            lazy = LazyEcommerce(dir_path)
+            self.assertEqual(lazy.line_index, {})
+            self.assertEqual(list(lazy.stores['s02'].pt_row()), list(final.stores['s02'].pt_row()))
+            self.assertNotIn("customers.txt", lazy.line_index)
+            self.assertEqual(lazy.loaded(), {'customers': (0, 3), 'stores': (1, 3)})
+            self.assertIn('c03', lazy.customers)
+            self.assertIn('s00', lazy.stores)
+            self.assertEqual(lazy.loaded(), {'customers': (0, 3), 'stores': (1, 3)}) # in only checks the key
+
+            self.assertEqual(list(lazy.customers['c03'].pt_row()), list(final.customers['c03'].pt_row()))
+            self.assertEqual(lazy.loaded(), {'customers': (1, 3), 'stores': (2, 3)}) # c03 only bought from s01 and s02
+            with self.assertRaises(KeyError):
+                lazy.stores['s99']
+
+            for cust_id, customer in final.customers.items():
+                self.assertEqual(list(lazy.customers[cust_id].pt_row()), list(customer.pt_row()))
+            for store_id, store in final.stores.items():
+                self.assertEqual(dict(lazy.stores[store_id].products), dict(store.products))
+            stream = io.StringIO()
+            lazy.store_report(stream, 'csv')
+            expected = io.StringIO()
+            final.store_report(expected, 'csv')
+            self.assertEqual(stream.getvalue(), expected.getvalue())
+
+            for write in (lazy.ingest, lambda: lazy.save_snapshot(os.path.join(dir_path, 'lazy.snap')), lambda: lazy.import_transactions(dir_path), lazy.tail):
+                with self.assertRaises(NotImplementedError):
+                    write()
+            self.assertFalse(os.path.exists(os.path.join(dir_path, 'lazy.snap')))
+            with self.assertRaises(TypeError):
+                OrderEngine(lazy)
+
+            metrics = Metrics()
+            measured = LazyEcommerce(dir_path, metrics=metrics)
+            measured.stores['s00']
+            measured.customers['c03']
+            report = metrics.report()['stages']
+            self.assertEqual(report['load_store']['calls'], 3) # s00, then s01 and s02 for c03
+            self.assertEqual(report['load_customer']['calls'], 1)
+            self.assertEqual(report['index_transactions']['bytes'], os.path.getsize(os.path.join(dir_path, "transactions.txt")))
+
+    def test_compact_store(self):
+        """Tests that the compact stores hold the same inventory, sales and report rows as the dict stores"""
+        with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            write_sample_data(dir_path)
+            final = Ecommerce(dir_path)
+            compact = Ecommerce(dir_path, compact=True)
+        for store_id, store in final.stores.items():
+            self.assertIsInstance(compact.stores[store_id], CompactStore)
+            self.assertEqual(compact.stores[store_id].products, store.products)
+            self.assertEqual(list(compact.stores[store_id].pt_row()), list(store.pt_row()))
+            self.assertEqual(list(compact.stores[store_id].recompute_rows()), list(store.recompute_rows()))
+            for product_id in store.products:
+                self.assertEqual(compact.stores[store_id].customer_count(product_id), store.customer_count(product_id))
+        for cust_id, customer in final.customers.items():
+            self.assertEqual(compact.customers[cust_id].products, customer.products)
+        self.assertEqual(compact.stores['s02'].products['p06'], 0)
+        self.assertEqual(compact.stores['s02'].customer_count('p05'), 3)
+        self.assertEqual(compact.stores['s02'].customer_count('p99'), 0)
+        self.assertEqual(compact.stores['s02'].customer_count('p00'), 0) # a product of another store
+        products = compact.stores['s02'].products # looking a product up doesn't stock it, like a defaultdict
+        self.assertIn('p05', products)
+        self.assertNotIn('p99', products)
+        self.assertEqual((products.get('p98'), products.get('p97', 0), products.get('p05')), (None, 0, final.stores['s02'].products['p05']))
+        self.assertEqual(list(products), ['p05', 'p06'])
+        self.assertNotIn('p98', compact.interner.codes)
+
+        CompactStore.MIN_LOG = 2 # force several merges of the sales log
+        try:
+            with tempfile.TemporaryDirectory() as dir_path, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+                write_sample_data(dir_path)
+                merged = Ecommerce(dir_path, compact=True)
+        finally:
+            CompactStore.MIN_LOG = 1 << 16
+        for store_id, store in final.stores.items():
+            self.assertEqual(list(merged.stores[store_id].pt_row()), list(store.pt_row()))
         
 
 if __name__ == '__main__':